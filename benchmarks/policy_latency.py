@@ -0,0 +1,102 @@
+"""Per-forward latency of the Baseline policy, eager versus compiled
+
+Usage: python -m benchmarks.policy_latency --num-envs 6 12
+
+Measures the rollout forward (no grad) on batches of num_envs x num_agents
+observation rows, the batch evaluate() runs inference on, taken from a
+reset environment. Runs on the CPU. The compiled forward needs torch>=2.0
+and is skipped on older versions. Any reinforcement_learning/config.py
+argument can be overridden from the command line.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+import torch
+
+from pufferlib.frameworks import cleanrl
+from pufferlib.vectorization import Serial
+
+import environment
+import train
+from reinforcement_learning import config, policy
+
+
+def measure(agent, obs, iterations, warmup):
+    latencies = []
+    with torch.no_grad():
+        for i in range(warmup + iterations):
+            start = time.perf_counter()
+            agent.get_action_and_value(obs)
+            if i >= warmup:
+                latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1e3
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "mean_ms": float(latencies.mean()),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-envs", type=int, nargs="+", default=[1, 6, 12])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--output", type=str, default="policy_latency.json")
+    bench_args, remaining = parser.parse_known_args()
+
+    sys.argv = sys.argv[:1] + remaining
+    args = config.create_config(config.Config)
+    args.tasks_path = train.BASELINE_CURRICULUM_FILE
+
+    envs = Serial(environment.make_env_creator(args), num_workers=1, envs_per_worker=1)
+    envs.async_reset(args.seed)
+    env_obs, _, _, _ = envs.recv()
+    env_obs = torch.as_tensor(np.asarray(env_obs), dtype=torch.float32)
+    task_embeddings = None
+    if args.task_index_obs:
+        _, task_embeddings = environment.load_task_table(args.tasks_path)
+
+    # Without torch.compile (torch < 2.0) only the eager forward is measured
+    compile_modes = (False, True) if hasattr(torch, "compile") else (False,)
+    results = []
+    for compile_mode in compile_modes:
+        torch.manual_seed(args.seed)
+        agent = cleanrl.Policy(policy.Baseline(
+            envs.driver_env,
+            input_size=args.input_size,
+            hidden_size=args.hidden_size,
+            task_size=args.task_size,
+            compile_mode=compile_mode,
+            task_embeddings=task_embeddings,
+            fused_decoder=args.fused_action_decoder,
+            sparse_entities=args.sparse_entity_encoding,
+        ))
+        for num_envs in bench_args.num_envs:
+            obs = env_obs.repeat(num_envs, 1)
+            result = {
+                "compiled": compile_mode,
+                "num_envs": num_envs,
+                "batch_size": len(obs),
+                **measure(agent, obs, bench_args.iterations, bench_args.warmup),
+            }
+            results.append(result)
+            print(result)
+    envs.close()
+
+    print(f"{'batch':>8} {'eager p50 ms':>14} {'compiled p50 ms':>16}")
+    for num_envs in bench_args.num_envs:
+        p50 = {r["compiled"]: r["p50_ms"] for r in results if r["num_envs"] == num_envs}
+        batch_size = next(r["batch_size"] for r in results if r["num_envs"] == num_envs)
+        compiled = f"{p50[True]:>16.2f}" if True in p50 else f"{'n/a':>16}"
+        print(f"{batch_size:>8} {p50[False]:>14.2f} {compiled}")
+
+    with open(bench_args.output, "w") as f:
+        json.dump(results, f, indent=2)
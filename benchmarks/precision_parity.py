@@ -0,0 +1,51 @@
+"""bf16 autocast versus fp32 policy outputs on a fixed rollout
+
+Usage: python -m benchmarks.precision_parity --num-envs 6 --rollout-batch-size 16384
+
+Collects one seeded rollout on the CPU, then runs the learner on its
+observations and actions in fp32 and under bf16 autocast. Exits non-zero
+when the mean absolute logprob difference exceeds --tolerance. Any
+reinforcement_learning/config.py argument can be overridden.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import train
+from reinforcement_learning import config
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=4096)
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("--output", type=str, default="precision_parity.json")
+    bench_args, remaining = parser.parse_known_args()
+
+    sys.argv = sys.argv[:1] + remaining
+    args = config.create_config(config.Config)
+    args.device = "cpu"
+    args.tasks_path = train.BASELINE_CURRICULUM_FILE
+    args.runs_dir = os.path.join(args.runs_dir, "benchmarks")
+    args.run_name = "precision_parity"
+    args.policy_store_dir = None
+    args.precision = "fp32"  # the rollout itself is collected in fp32
+
+    trainer = train.setup_env(args)
+    try:
+        trainer.evaluate()
+        report = trainer.precision_parity(bench_args.rows)
+    finally:
+        trainer.close()
+
+    for key, value in report.items():
+        print(f"{key:>24} {value}")
+    with open(bench_args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if report["logprob/mean_abs_diff"] > bench_args.tolerance:
+        sys.exit(1)
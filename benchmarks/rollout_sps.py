@@ -0,0 +1,70 @@
+"""Rollout SPS versus num_buffers, with and without the pipelined rollout
+
+Usage: python -m benchmarks.rollout_sps --num-envs 6 --rollout-batch-size 16384
+
+Runs on the CPU. Any reinforcement_learning/config.py argument can be
+overridden from the command line; the benchmark-specific options are below.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import train
+from reinforcement_learning import config
+
+
+def measure(args, num_buffers, pipelined, num_epochs):
+    args.num_buffers = num_buffers
+    args.pipelined_rollout = pipelined
+    args.run_name = f"rollout_sps_b{num_buffers}_{'pipelined' if pipelined else 'serial'}"
+    args.policy_store_dir = None
+
+    trainer = train.setup_env(args)
+    try:
+        trainer.evaluate()  # warm up envs and policy
+        start = time.time()
+        for _ in range(num_epochs):
+            trainer.evaluate()
+        elapsed = time.time() - start
+    finally:
+        trainer.close()
+
+    return {
+        "num_buffers": num_buffers,
+        "pipelined": pipelined,
+        "sps": int(num_epochs * args.rollout_batch_size / elapsed),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--buffers", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--output", type=str, default="rollout_sps.json")
+    bench_args, remaining = parser.parse_known_args()
+
+    sys.argv = sys.argv[:1] + remaining
+    args = config.create_config(config.Config)
+    args.device = "cpu"
+    args.tasks_path = train.BASELINE_CURRICULUM_FILE
+    args.runs_dir = os.path.join(args.runs_dir, "benchmarks")
+
+    results = []
+    for num_buffers in bench_args.buffers:
+        for pipelined in (False, True):
+            result = measure(args, num_buffers, pipelined, bench_args.epochs)
+            results.append(result)
+            print(result)
+
+    print(f"{'buffers':>8} {'serial SPS':>12} {'pipelined SPS':>14}")
+    for num_buffers in bench_args.buffers:
+        sps = {r["pipelined"]: r["sps"] for r in results if r["num_buffers"] == num_buffers}
+        print(f"{num_buffers:>8} {sps[False]:>12} {sps[True]:>14}")
+
+    with open(bench_args.output, "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,154 @@
+"""Pick rollout_batch_size, ppo_training_batch_size and bptt_horizon for this node
+
+Usage: python -m benchmarks.tune_shapes --max-rss-gb 28 --output shapes.json
+       python train.py --config-overrides shapes.json
+
+Every valid shape in the grid trains the real Baseline policy for a few
+updates on a synthetic rollout, in a fresh process so that its peak RSS is
+its own. The rollout tiles observations of a reset environment, and its
+actions, logprobs and values come from the policy itself. The fastest
+shape within the memory budget is written as a config override file. Any
+reinforcement_learning/config.py argument can be overridden from the
+command line.
+"""
+import argparse
+import copy
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import torch
+
+import train
+from reinforcement_learning import config
+
+SHAPE_KEYS = ("rollout_batch_size", "ppo_training_batch_size", "bptt_horizon")
+
+
+def valid_shapes(rollout_batch_sizes, training_batch_sizes, bptt_horizons):
+    for rollout, training, bptt in itertools.product(
+            rollout_batch_sizes, training_batch_sizes, bptt_horizons):
+        if training % bptt == 0 and rollout % training == 0:
+            yield dict(zip(SHAPE_KEYS, (rollout, training, bptt)))
+
+
+def synthetic_rollout(trainer):
+    '''Fill the trainer's rollout storage as evaluate() would'''
+    data = trainer.data
+    num_rows = trainer.batch_size + 1
+    num_slots = trainer.num_envs * trainer.num_agents
+
+    obs, _, _, _ = trainer.buffers[0].recv()
+    obs = torch.as_tensor(obs, dtype=torch.float32).to(trainer.device)
+    with torch.no_grad():
+        actions, logprobs, _, values = trainer.agent.get_action_and_value(obs)
+
+    repeats = -(-num_rows // len(obs))
+    rows = slice(0, num_rows)
+    data.obs[rows] = obs.repeat(repeats, 1)[rows].to(data.obs.device)
+    data.actions[rows] = actions.view(len(obs), -1).repeat(repeats, 1)[rows]
+    data.logprobs[rows] = logprobs.repeat(repeats)[rows]
+    data.values[rows] = values.flatten().repeat(repeats)[rows]
+    data.rewards[rows] = torch.randn(num_rows, device=data.rewards.device)
+    data.dones[rows] = 0
+
+    def reset_order():
+        data.sort_keys = [(0, i % num_slots, i // num_slots) for i in range(num_rows)]
+
+    return reset_order
+
+
+def measure(args, updates, result_queue):
+    trainer = train.setup_env(args)
+    try:
+        # Tuning runs write no checkpoints; stop the writer thread first
+        if trainer.checkpoint_writer is not None:
+            trainer.checkpoint_writer.close()
+            trainer.checkpoint_writer = None
+
+        reset_order = synthetic_rollout(trainer)
+        kwargs = dict(
+            update_epochs=args.ppo_update_epochs,
+            bptt_horizon=args.bptt_horizon,
+            batch_rows=args.ppo_training_batch_size // args.bptt_horizon,
+            clip_coef=args.clip_coef,
+            grad_accumulation_steps=args.ppo_grad_accumulation_steps,
+        )
+
+        reset_order()
+        trainer.train(**kwargs)  # warm up
+        start = time.time()
+        for _ in range(updates):
+            reset_order()
+            trainer.train(**kwargs)
+        elapsed = time.time() - start
+    finally:
+        trainer.close()
+
+    result_queue.put({
+        "train_sps": int(updates * args.rollout_batch_size / elapsed),
+        "peak_rss_gb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6,
+    })
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rollout-batch-sizes", type=int, nargs="+", default=[2**14, 2**15, 2**16])
+    parser.add_argument("--training-batch-sizes", type=int, nargs="+", default=[64, 128, 256, 512])
+    parser.add_argument("--bptt-horizons", type=int, nargs="+", default=[8, 16])
+    parser.add_argument("--updates", type=int, default=2)
+    parser.add_argument("--max-rss-gb", type=float, default=None)
+    parser.add_argument("--output", type=str, default="shapes.json")
+    tune_args, remaining = parser.parse_known_args()
+
+    sys.argv = sys.argv[:1] + remaining
+    args = config.create_config(config.Config)
+    args.tasks_path = train.BASELINE_CURRICULUM_FILE
+    args.runs_dir = os.path.join(args.runs_dir, "benchmarks")
+    args.num_envs = 1
+    args.num_cores = 1
+    args.num_buffers = 1
+    args.use_serial_vecenv = True
+    args.trajectory_storage = False  # synthetic_rollout fills flat storage
+    args.async_rollout = False
+    args.train_num_steps = 2**40  # never done_training()
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    shapes = valid_shapes(
+        tune_args.rollout_batch_sizes, tune_args.training_batch_sizes, tune_args.bptt_horizons)
+    for shape in shapes:
+        run_args = copy.copy(args)
+        vars(run_args).update(shape)
+        run_args.run_name = "tune_shapes_" + "_".join(str(v) for v in shape.values())
+        run_args.policy_store_dir = None
+
+        result_queue = context.Queue()
+        process = context.Process(
+            target=measure, args=(run_args, tune_args.updates, result_queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"{shape} failed with exit code {process.exitcode}")
+            continue
+
+        result = {**shape, **result_queue.get()}
+        results.append(result)
+        print(result)
+
+    feasible = [r for r in results
+                if tune_args.max_rss_gb is None or r["peak_rss_gb"] <= tune_args.max_rss_gb]
+    if not feasible:
+        sys.exit("No shape trained within the memory budget")
+
+    best = max(feasible, key=lambda r: r["train_sps"])
+    print(f"Best: {best}")
+    with open(tune_args.output, "w") as f:
+        json.dump({k: best[k] for k in SHAPE_KEYS}, f, indent=2)
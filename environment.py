@@ -1,6 +1,10 @@
 from argparse import Namespace
+import functools
 import math
 
+import dill
+import gym
+import numpy as np
 import nmmo
 import pufferlib
 import pufferlib.emulation
@@ -31,6 +35,19 @@ class Config(nmmo.config.Default):
 
         self.COMBAT_SPAWN_IMMUNITY = args.spawn_immunity
 
+@functools.lru_cache()
+def load_task_table(curriculum_file):
+    '''Task spec names and [num_tasks, task_size] embeddings, in file order
+
+    The result is cached and shared by every caller, so it is immutable.
+    '''
+    with open(curriculum_file, "rb") as f:
+        task_specs = dill.load(f)
+    names = tuple(spec.name for spec in task_specs)
+    embeddings = np.stack([spec.embedding for spec in task_specs]).astype(np.float32)
+    embeddings.flags.writeable = False
+    return names, embeddings
+
 class Postprocessor(StatPostprocessor):
     def __init__(self, env, is_multiagent, agent_id,
         eval_mode=False,
@@ -40,6 +57,7 @@ class Postprocessor(StatPostprocessor):
         meander_bonus_weight=0,
         explore_bonus_weight=0,
         clip_unique_event=3,
+        task_index_file=None,
     ):
         super().__init__(env, agent_id, eval_mode)
         self.early_stop_agent_num = early_stop_agent_num
@@ -49,24 +67,49 @@ class Postprocessor(StatPostprocessor):
         self.explore_bonus_weight = explore_bonus_weight
         self.clip_unique_event = clip_unique_event
 
+        # With a task index file, "Task" is the index of the agent's task spec
+        # in that curriculum file instead of its task_size embedding. The
+        # policy looks the embedding up in the same file
+        self.task_index = None
+        if task_index_file is not None:
+            names, _ = load_task_table(task_index_file)
+            self.task_index = {name: i for i, name in enumerate(names)}
+        self._task_obs = None
+
     def reset(self, obs):
         '''Called at the start of each episode'''
         super().reset(obs)
+        self._task_obs = None
 
     @property
     def observation_space(self):
         '''If you modify the shape of features, you need to specify the new obs space'''
-        return super().observation_space
+        space = super().observation_space
+        if self.task_index is None:
+            return space
+
+        spaces = dict(space.spaces)
+        spaces["Task"] = gym.spaces.Box(
+            low=0, high=len(self.task_index) - 1, shape=(1,), dtype=np.int32)
+        return gym.spaces.Dict(spaces)
 
-    """
     def observation(self, obs):
         '''Called before observations are returned from the environment
 
         Use this to define custom featurizers. Changing the space itself requires you to
         define the observation space again (i.e. Gym.spaces.Dict(gym.spaces....))
         '''
+        obs = super().observation(obs)
+        if self.task_index is not None:
+            if self._task_obs is None:
+                task = self.env.agent_task_map[self.agent_id][0]
+                if task.spec_name not in self.task_index:
+                    raise KeyError(f"Task {task.spec_name} is not in the task index file")
+                self._task_obs = np.array([self.task_index[task.spec_name]], dtype=np.int32)
+            obs["Task"] = self._task_obs
         return obs
 
+    """
     def action(self, action):
         '''Called before actions are passed from the model to the environment'''
         return action
@@ -124,6 +167,7 @@ def make_env_creator(args: Namespace):
                 'heal_bonus_weight': args.heal_bonus_weight,
                 'meander_bonus_weight': args.meander_bonus_weight,
                 'explore_bonus_weight': args.explore_bonus_weight,
+                'task_index_file': args.tasks_path if args.task_index_obs else None,
             },
         )
         return env
@@ -0,0 +1,51 @@
+# Generalized advantage estimation for CleanPuffeRL
+import numpy as np
+import torch
+
+# A step of the scan vectorized across segments costs about this many
+# steps of the per-sample loop
+SEGMENT_STEP_COST = 16
+
+
+def compute_gae(values, dones, rewards, idxs, gamma, gae_lambda):
+    '''GAE over the samples of a rollout, visited in `idxs` order
+
+    idxs has batch_size + 1 entries; idxs[t + 1] is the sample that follows
+    idxs[t]. The elementwise terms are computed as whole tensors and only the
+    reverse recursion runs sequentially, in float32 on the host, so the
+    advantages match the per-sample loop bit for bit.
+
+    The recursion restarts after every sample whose next sample is terminal
+    (coef is 0 there), so it runs over those segments side by side when the
+    longest one is short enough for that to be faster.
+    '''
+    idxs = torch.as_tensor(idxs, dtype=torch.long, device=values.device)
+    cur, nxt = idxs[:-1], idxs[1:]
+
+    nextnonterminal = 1.0 - dones[nxt]
+    delta = rewards[nxt] + gamma * values[nxt] * nextnonterminal - values[cur]
+    coef = gamma * gae_lambda * nextnonterminal
+
+    delta = delta.float().cpu().numpy()
+    coef = coef.float().cpu().numpy()
+    advantages = np.empty_like(delta)
+
+    # Last sample of every segment, longest segments first
+    ends = np.append(np.flatnonzero(coef[:-1] == 0), len(delta) - 1)
+    lengths = np.diff(ends, prepend=-1)
+    if lengths.max() * SEGMENT_STEP_COST >= len(delta):
+        lastgaelam = np.float32(0)
+        for t in range(len(delta) - 1, -1, -1):
+            advantages[t] = lastgaelam = delta[t] + coef[t] * lastgaelam
+        return torch.from_numpy(advantages).to(values.device)
+
+    order = np.argsort(-lengths, kind="stable")
+    ends, lengths = ends[order], lengths[order]
+    # Number of segments longer than j, for every step j back from their ends
+    active = np.searchsorted(-lengths, -np.arange(lengths[0]), side="left")
+    lastgaelam = np.zeros(len(ends), dtype=np.float32)
+    for j, rows in enumerate(active):
+        t = ends[:rows] - j
+        advantages[t] = lastgaelam[:rows] = delta[t] + coef[t] * lastgaelam[:rows]
+
+    return torch.from_numpy(advantages).to(values.device)
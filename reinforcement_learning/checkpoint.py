@@ -0,0 +1,142 @@
+# Background checkpoint writing for CleanPuffeRL
+import os
+import queue
+import re
+import threading
+
+import torch
+
+
+def to_cpu(obj):
+    '''Copy of a (nested) state dict with every tensor cloned to the CPU'''
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def retained(updates, keep_last=0, keep_every=0, interval=1):
+    '''Checkpoint updates kept by the retention policy
+
+    Checkpoints are saved at updates 1, interval + 1, 2 * interval + 1 and
+    so on. The newest keep_last checkpoints and every keep_every-th saved
+    checkpoint (the 1st, the keep_every + 1-th, ...) are kept, counted by
+    their position in that sequence so pruning does not shift it. The
+    newest checkpoint, which trainer.pt names, is always kept. With both
+    at 0, every checkpoint is kept.
+    '''
+    updates = sorted(updates)
+    if not keep_last and not keep_every:
+        return set(updates)
+
+    keep = set(updates[-keep_last:]) if keep_last else set()
+    if keep_every:
+        keep.update(u for u in updates if (u - 1) // interval % keep_every == 0)
+    if updates:
+        keep.add(updates[-1])
+    return keep
+
+
+class CheckpointWriter:
+    '''Serializes checkpoints on a background thread
+
+    submit() takes a policy state dict and trainer state that were already
+    copied off the training device, so training continues while they are
+    written. The state dict is loaded into policy, a CPU copy of the trained
+    policy made once, which is added to the policy store before trainer.pt
+    is replaced atomically, so trainer.pt never names a missing policy.
+    Policies named "{exp_name}.{update:06d}" beyond the retention policy
+    are then deleted from policy_dir, the policy store's directory, along
+    with the "_state.pth" state dicts saved next to them.
+
+    At most max_pending checkpoints wait to be written; submit() blocks
+    beyond that. Names of written policies are returned by completed().
+    '''
+    def __init__(self, data_dir, policy_store, policy_dir, exp_name, policy,
+                 keep_last=0, keep_every=0, interval=1, max_pending=1):
+        self.data_dir = data_dir
+        self.policy = policy
+        self.policy_store = policy_store
+        self.policy_dir = policy_dir
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.interval = interval
+        self.pattern = re.compile(re.escape(exp_name) + r"\.(\d+)(\.pt|_state\.pth)$")
+
+        self._error = None
+        self._completed = queue.Queue()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, policy_name, state_dict, trainer_state):
+        self._raise()
+        self._queue.put((policy_name, state_dict, trainer_state))
+
+    def completed(self):
+        names = []
+        while not self._completed.empty():
+            names.append(self._completed.get())
+        return names
+
+    def flush(self):
+        '''Block until every submitted checkpoint is written'''
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self._error is not None:
+            raise RuntimeError("Checkpoint writer failed") from self._error
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    self._write(*job)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, policy_name, state_dict, trainer_state):
+        # NOTE: as the agent_creator has args internally, the policy args are not passed
+        self.policy.load_state_dict(state_dict)
+        self.policy_store.add_policy(policy_name, self.policy)
+
+        path = os.path.join(self.data_dir, "trainer.pt")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            torch.save(trainer_state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        self._completed.put(policy_name)
+        self._prune()
+
+    def _prune(self):
+        if self.policy_dir is None or not os.path.isdir(self.policy_dir):
+            return
+
+        files = {}
+        for name in os.listdir(self.policy_dir):
+            match = self.pattern.match(name)
+            if match:
+                files.setdefault(int(match.group(1)), []).append(name)
+
+        keep = retained(files, self.keep_last, self.keep_every, self.interval)
+        for update, names in files.items():
+            if update not in keep:
+                for name in names:
+                    os.remove(os.path.join(self.policy_dir, name))
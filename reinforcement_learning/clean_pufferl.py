@@ -2,8 +2,11 @@
 # PufferLib's customized CleanRL PPO + LSTM implementation
 from pdb import set_trace as T
 
+import copy
 import os
+import queue
 import random
+import threading
 import time
 from collections import defaultdict
 from dataclasses import dataclass
@@ -13,6 +16,7 @@ from types import SimpleNamespace
 import numpy as np
 import psutil
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
 import wandb
@@ -26,6 +30,16 @@ import pufferlib.policy_ranker
 import pufferlib.utils
 import pufferlib.vectorization
 
+from reinforcement_learning import checkpoint
+from reinforcement_learning import distributed
+from reinforcement_learning.advantages import compute_gae
+from reinforcement_learning.loss_recorder import LossRecorder
+from reinforcement_learning import prefetch
+from reinforcement_learning import profiling
+from reinforcement_learning import stats as rollout_stats
+from reinforcement_learning import storage
+from reinforcement_learning.vectorization import SharedMemoryMultiprocessing
+
 
 def unroll_nested_dict(d):
     if not isinstance(d, dict):
@@ -52,6 +66,10 @@ class CleanPuffeRL:
     data_dir: str = 'data'
     record_loss: bool = False
     checkpoint_interval: int = 1
+    # Retention of this run's policy checkpoints: the newest keep_last and
+    # every keep_every-th update. 0 and 0 keeps everything
+    checkpoint_keep_last: int = 0
+    checkpoint_keep_every: int = 0
     seed: int = 1
     torch_deterministic: bool = True
     vectorization: ... = pufferlib.vectorization.Serial
@@ -64,7 +82,49 @@ class CleanPuffeRL:
     cpu_offload: bool = True
     verbose: bool = True
     batch_size: int = 2**14
+
+    # Store samples directly in a [slots, horizon] per-agent trajectory layout
+    # (slot = buffer x env x agent) instead of sorting flat samples in train()
+    trajectory_storage: bool = False
+    trajectory_horizon: int = None  # None: twice the average samples per learner slot
+
+    # Keep each flat observation segment in its narrowest lossless dtype and
+    # decode to float32 per minibatch in train()
+    compress_obs: bool = False
+
+    # Only run the policy on live agent rows. Requires a single
+    # non-recurrent policy in the pool
+    compact_inference: bool = False
+
+    # Per-stage rollout latency histograms. Per-worker env timings need an
+    # extra round trip to every worker, so they are opt-in, and need the
+    # SharedMemoryMultiprocessing vecenv
+    profile_workers: bool = False
+
+    # Run recv, inference/send and storage on separate threads, connected by
+    # queues of pipeline_depth steps
+    pipelined_rollout: bool = False
+    pipeline_depth: int = 2
+
+    # "fp32", or "bf16" to run policy forwards under bfloat16 autocast.
+    # Losses, reductions and the optimizer stay in fp32
+    precision: str = "fp32"
+
+    # "memory" keeps observations in process memory; "mmap" keeps them in
+    # memory-mapped files under data_dir/rollout so the page cache holds them
+    storage_backend: str = "memory"
+
+    # Gather each minibatch's observations from data.obs inside the epoch
+    # loop instead of keeping a reordered copy of the whole rollout
+    lazy_obs_gather: bool = False
+
+    # Minibatches whose observations are gathered, decoded and moved to the
+    # device on a background thread ahead of the update. 0 loads them inline
+    prefetch_depth: int = 0
     policy_store: pufferlib.policy_store.PolicyStore = None
+    # Directory of policy_store, where old checkpoints are pruned. Set when
+    # the trainer creates the store under data_dir
+    policy_store_dir: str = None
     policy_ranker: pufferlib.policy_ranker.PolicyRanker = None
 
     policy_pool: pufferlib.policy_pool.PolicyPool = None
@@ -79,9 +139,29 @@ class CleanPuffeRL:
     selfplay_learner_weight: float = 1.0
     selfplay_num_policies: int = 1
 
+    # Data-parallel learner in an initialized torch.distributed process
+    # group (see distributed.launch). batch_size and total_timesteps are per
+    # learner, and train() batch_rows is this learner's shard of each
+    # minibatch. Only rank 0 logs to wandb and writes checkpoints
+    distributed: bool = False
+
+    # Collect the next batch on a background thread with a snapshot of the
+    # learner (the actor) while the current batch trains. See
+    # start_async_evaluate(). The actor is refreshed whenever the batch
+    # would otherwise be trained more than max_policy_lag updates after the
+    # actor's weights were taken. Doubles rollout storage
+    async_rollout: bool = False
+    max_policy_lag: int = 1
+
     def __post_init__(self, *args, **kwargs):
         self.start_time = time.time()
 
+        self.rank, self.world_size = 0, 1
+        if self.distributed:
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+            if self.rank != 0:
+                self.wandb_entity = None
+
         # If data_dir is provided, load the resume state
         resume_state = {}
         if self.data_dir is not None:
@@ -137,14 +217,15 @@ class CleanPuffeRL:
         # Create policy store
         if self.policy_store is None:
             if self.data_dir is not None:
+                self.policy_store_dir = os.path.join(self.data_dir, "policies")
                 self.policy_store = pufferlib.policy_store.DirectoryPolicyStore(
-                    os.path.join(self.data_dir, "policies")
+                    self.policy_store_dir
                 )
 
         # Create policy ranker
         if self.policy_ranker is None:
             if self.data_dir is not None:
-                db_file = os.path.join(self.data_dir, "ranking.sqlite")
+                db_file = os.path.join(self.data_dir, self._rank_path("ranking.sqlite"))
                 self.policy_ranker = pufferlib.policy_ranker.OpenSkillRanker(db_file, "anchor")
             if "learner" not in self.policy_ranker.ratings():
                 self.policy_ranker.add_policy("learner")
@@ -158,11 +239,22 @@ class CleanPuffeRL:
         # TODO: this can be cleaned up
         self.agent.is_recurrent = hasattr(self.agent, "lstm")
         self.agent = self.agent.to(self.device)
+        if self.distributed:
+            distributed.broadcast_parameters(self.agent)
+
+        # The actor runs rollouts. It is a separate copy of the learner only
+        # in async mode, where rollouts overlap training
+        self.actor = self.agent
+        self.actor_version = self.update
+        if self.async_rollout:
+            assert self.max_policy_lag >= 1, "async_rollout needs max_policy_lag >= 1"
+            self.actor = copy.deepcopy(self.agent)
+        self._async_rollout = None
 
         # Setup policy pool
         if self.policy_pool is None:
             self.policy_pool = pufferlib.policy_pool.PolicyPool(
-                self.agent,
+                self.actor,
                 "learner",
                 num_envs=self.num_envs,
                 num_agents=self.num_agents,
@@ -176,6 +268,21 @@ class CleanPuffeRL:
                 self.selfplay_num_policies - 1, exclude_names="learner"
             )
 
+        # Checkpoints are written in the background by rank 0
+        self.checkpoint_writer = None
+        if self.data_dir is not None and self.policy_store is not None and self.rank == 0:
+            self.checkpoint_writer = checkpoint.CheckpointWriter(
+                self.data_dir,
+                self.policy_store,
+                self.policy_store_dir,
+                self.exp_name,
+                # Checkpoints load their state dicts into this one CPU copy
+                copy.deepcopy(self.agent).to("cpu"),
+                keep_last=self.checkpoint_keep_last,
+                keep_every=self.checkpoint_keep_every,
+                interval=self.checkpoint_interval,
+            )
+
         # Setup optimizer
         self.optimizer = optim.Adam(
             self.agent.parameters(), lr=self.learning_rate, eps=1e-5
@@ -186,7 +293,7 @@ class CleanPuffeRL:
         ### Allocate Storage
         next_obs, next_done, next_lstm_state = [], [], []
         for i, envs in enumerate(self.buffers):
-            envs.async_reset(self.seed + i)
+            envs.async_reset(self.seed + self.rank * self.num_buffers + i)
             next_done.append(
                 torch.zeros((self.num_envs * self.num_agents,)).to(self.device)
             )
@@ -207,25 +314,51 @@ class CleanPuffeRL:
             else:
                 next_lstm_state.append(None)
 
+        # Trajectory storage gives every agent slot its own row of `horizon`
+        # samples. Flat storage appends samples and sorts them in train()
+        num_rows = self.batch_size + 1
+        num_slots = self.num_buffers * self.num_envs * self.num_agents
+        horizon = 0
+        if self.trajectory_storage:
+            # Only learner slots are stored, so size the horizon from them
+            learner_slots = num_slots
+            if self.selfplay_learner_weight > 0:
+                learner_slots = self.num_buffers * int(np.sum(self.policy_pool.learner_mask))
+            assert learner_slots > 0, "trajectory_storage needs at least one learner slot"
+            horizon = self.trajectory_horizon or -(-2 * num_rows // learner_slots)
+            assert learner_slots * horizon >= num_rows, \
+                "trajectory_horizon is too small to hold batch_size + 1 samples"
+            num_rows = num_slots * horizon
+
+        # Per-buffer host (and device) tensors that recv() outputs are copied
+        # into. Host tensors are pinned when training on a GPU
+        self.staging = [{} for _ in range(self.num_buffers)]
+        self.pin_staging = torch.device(self.device).type == "cuda"
+        self.staging_stats = {"allocations": 0, "allocated_bytes": 0, "copies": 0}
+
+        assert self.storage_backend in ("memory", "mmap"), \
+            f"Unknown storage_backend {self.storage_backend}"
+        assert self.storage_backend == "memory" or self.data_dir is not None, \
+            "storage_backend=mmap requires data_dir"
+        assert self.precision in ("fp32", "bf16"), f"Unknown precision {self.precision}"
+        assert not self.profile_workers or \
+            self.vectorization is SharedMemoryMultiprocessing, \
+            "profile_workers requires the SharedMemoryMultiprocessing vecenv"
+
+        # self.data is the rollout being collected and self.train_data the
+        # one train() consumes. They only differ in async mode, where the two
+        # storages alternate and the env stream state moves with self.data
         allocated_torch = torch.cuda.memory_allocated(self.device)
         allocated_cpu = self.process.memory_info().rss
-        self.data = SimpleNamespace(
-            buf=0,
-            sort_keys=[],
-            next_obs=next_obs,
-            next_done=next_done,
-            next_lstm_state=next_lstm_state,
-            obs=torch.zeros(
-                self.batch_size + 1, *self.buffers[0].single_observation_space.shape
-            ).to("cpu" if self.cpu_offload else self.device),
-            actions=torch.zeros(
-                self.batch_size + 1, *self.buffers[0].single_action_space.shape, dtype=int
-            ).to(self.device),
-            logprobs=torch.zeros(self.batch_size + 1).to(self.device),
-            rewards=torch.zeros(self.batch_size + 1).to(self.device),
-            dones=torch.zeros(self.batch_size + 1).to(self.device),
-            values=torch.zeros(self.batch_size + 1).to(self.device),
-        )
+        self.rollouts = [
+            self._allocate_rollout(num_rows, horizon, num_slots, i)
+            for i in range(2 if self.async_rollout else 1)
+        ]
+        self.data = self.train_data = self.rollouts[0]
+        self.data.buf = 0
+        self.data.next_obs = next_obs
+        self.data.next_done = next_done
+        self.data.next_lstm_state = next_lstm_state
 
         allocated_torch = torch.cuda.memory_allocated(self.device) - allocated_torch
         allocated_cpu = self.process.memory_info().rss - allocated_cpu
@@ -235,13 +368,15 @@ class CleanPuffeRL:
                 % (allocated_torch / 1e9, allocated_cpu / 1e9)
             )
 
-        if self.record_loss and self.data_dir is not None:
-            self.loss_file = os.path.join(self.data_dir, "loss.txt")
-            with open(self.loss_file, "w") as f:
-                pass
-            self.action_file = os.path.join(self.data_dir, "actions.txt")
-            with open(self.action_file, "w") as f:
-                pass
+        self.loss_recorder = None
+        if self.record_loss and self.data_dir is not None and self.rank == 0:
+            self.loss_recorder = LossRecorder(os.path.join(self.data_dir, "losses"))
+
+        self.profiler = profiling.RolloutProfiler()
+        self.performance_sink = None
+        if self.data_dir is not None and self.rank == 0:
+            self.performance_sink = profiling.JsonlSink(
+                os.path.join(self.data_dir, "performance.jsonl"))
 
         if self.wandb_entity is not None:
             self.wandb_run_id = self.wandb_run_id or wandb.util.generate_id()
@@ -260,6 +395,85 @@ class CleanPuffeRL:
 
     @pufferlib.utils.profile
     def evaluate(self, show_progress=False):
+        assert self._async_rollout is None, "An async rollout is in progress"
+        rollout = self._begin_rollout(show_progress)
+        self._collect(rollout)
+        return self._finish_rollout(rollout)
+
+    def start_async_evaluate(self, show_progress=False):
+        '''Start collecting the next batch on a background thread
+
+        Call finish_async_evaluate() to wait for it, then train() on it while
+        the following batch is collected:
+
+            trainer.start_async_evaluate()
+            while not trainer.done_training():
+                trainer.finish_async_evaluate()
+                trainer.start_async_evaluate()
+                trainer.train()
+            trainer.cancel_async_evaluate()
+
+        The policy pool and ranks are updated on the calling thread.
+        '''
+        assert self.async_rollout, "start_async_evaluate() requires async_rollout"
+        assert self._async_rollout is None, "An async rollout is in progress"
+
+        # The batch trains at the next update at the earliest
+        if self.update + 1 - self.actor_version > self.max_policy_lag:
+            self.actor.load_state_dict(self.agent.state_dict())
+            self.actor_version = self.update
+
+        rollout = self._begin_rollout(show_progress)
+        rollout.error = None
+
+        def collect():
+            try:
+                self._collect(rollout)
+            except Exception as e:
+                rollout.error = e
+
+        rollout.thread = threading.Thread(target=collect, daemon=True)
+        rollout.thread.start()
+        self._async_rollout = rollout
+
+    def finish_async_evaluate(self):
+        '''Wait for the background rollout; returns what evaluate() returns
+
+        The finished batch becomes train_data, and the next rollout is
+        collected into the other storage, continuing the same env streams.
+        '''
+        rollout, self._async_rollout = self._async_rollout, None
+        assert rollout is not None, "No async rollout in progress"
+        rollout.thread.join()
+        if rollout.error is not None:
+            raise rollout.error
+
+        result = self._finish_rollout(rollout)
+        finished = self.data
+        # By identity: rollouts hold arrays, which do not compare as bools
+        index = [rollout is finished for rollout in self.rollouts].index(True)
+        self.data = self.rollouts[(index + 1) % len(self.rollouts)]
+        for name in ("buf", "next_obs", "next_done", "next_lstm_state"):
+            setattr(self.data, name, getattr(finished, name))
+        return result
+
+    def cancel_async_evaluate(self):
+        '''Stop the background rollout and drop its batch without logging it
+
+        Steps already received are still sent, so the env streams stay
+        consistent. Does nothing if no async rollout is in progress.
+        '''
+        rollout, self._async_rollout = self._async_rollout, None
+        if rollout is None:
+            return
+
+        rollout.counts.cancelled = True
+        rollout.thread.join()
+        rollout.progress_bar.close()
+        if rollout.error is not None:
+            raise rollout.error
+
+    def _begin_rollout(self, show_progress):
         # Pick new policies for the policy pool
         # TODO: find a way to not switch mid-stream
         self.policy_pool.update_policies({
@@ -269,126 +483,46 @@ class CleanPuffeRL:
             ) for p in self.policy_store.select_policies(self.policy_selector)
         })
 
-        allocated_torch = torch.cuda.memory_allocated(self.device)
-        allocated_cpu = self.process.memory_info().rss
-        ptr = env_step_time = inference_time = agent_steps_collected = 0
-        padded_steps_collected = 0
-
-        step = 0
-        infos = defaultdict(lambda: defaultdict(list))
-        stats = defaultdict(lambda: defaultdict(list))
-        performance = defaultdict(list)
-        progress_bar = tqdm(total=self.batch_size, disable=not show_progress)
-
+        # Every evaluate() collects a fresh batch
         data = self.data
-        while True:
-            buf = data.buf
-
-            step += 1
-            if ptr == self.batch_size + 1:
-                break
-
-            start = time.time()
-            o, r, d, i = self.buffers[buf].recv()
-            env_step_time += time.time() - start
-
-            i = self.policy_pool.update_scores(i, "return")
-
-            '''
-            for profile in self.buffers[buf].profile():
-                for k, v in profile.items():
-                    performance[k].append(v["delta"])
-            '''
-
-            o = torch.Tensor(o)
-            if not self.cpu_offload:
-                o = o.to(self.device)
-
-            r = torch.Tensor(r).float().to(self.device).view(-1)
-
-            if len(d) != 0 and len(data.next_done[buf]) != 0:
-                alive_mask = (data.next_done[buf].cpu() + torch.Tensor(d)) != 2
-                data.next_done[buf] = torch.Tensor(d).to(self.device)
-            else:
-                alive_mask = [1 for _ in range(len(o))]
-
-            agent_steps_collected += sum(alive_mask)
-            padded_steps_collected += len(alive_mask)
-
-            # ALGO LOGIC: action logic
-            start = time.time()
-            with torch.no_grad():
-                (
-                    actions,
-                    logprob,
-                    value,
-                    data.next_lstm_state[buf],
-                ) = self.policy_pool.forwards(
-                    o.to(self.device),
-                    data.next_lstm_state[buf],
-                    data.next_done[buf],
-                )
-                value = value.flatten()
-            inference_time += time.time() - start
-
-            # TRY NOT TO MODIFY: execute the game
-            start = time.time()
-            self.buffers[buf].send(actions.cpu().numpy(), None)
-            env_step_time += time.time() - start
-            data.buf = (data.buf + 1) % self.num_buffers
-
-            # Index alive mask with policy pool idxs...
-            # TODO: Find a way to avoid having to do this
-            if self.selfplay_learner_weight > 0:
-              alive_mask = np.array(alive_mask) * self.policy_pool.learner_mask
+        self.clear_rollout(data)
+        data.policy_version = self.actor_version if self.async_rollout else self.update
+
+        return SimpleNamespace(
+            data=data,
+            allocated_torch=torch.cuda.memory_allocated(self.device),
+            allocated_cpu=self.process.memory_info().rss,
+            staging_allocations=self.staging_stats["allocations"],
+            stats=rollout_stats.StreamingStats(),
+            progress_bar=tqdm(total=self.batch_size, disable=not show_progress),
+            counts=SimpleNamespace(
+                ptr=0, step=0, agent_steps=0, padded_steps=0, inference_rows=0,
+                full_buffers=set(), cancelled=False),
+        )
 
-            for idx in np.where(alive_mask)[0]:
-                if ptr == self.batch_size + 1:
-                    break
+    def _collect(self, rollout):
+        '''Step the envs until rollout.data holds batch_size + 1 samples'''
+        if rollout.data.allocator is not None:
+            rollout.data.allocator.advise_sequential()
+        self.profiler.reset()
+        rollout.time = time.time()
+        if self.pipelined_rollout:
+            self._rollout_pipelined(rollout.counts, rollout.stats, rollout.progress_bar)
+        else:
+            self._rollout_serial(rollout.counts, rollout.stats, rollout.progress_bar)
+        rollout.time = time.time() - rollout.time
 
-                data.obs[ptr] = o[idx]
-                data.values[ptr] = value[idx]
-                data.actions[ptr] = actions[idx]
-                data.logprobs[ptr] = logprob[idx]
-                data.sort_keys.append((buf, idx, step))
-
-                if len(d) != 0:
-                    data.rewards[ptr] = r[idx]
-                    data.dones[ptr] = d[idx]
-
-                ptr += 1
-                progress_bar.update(1)
-
-            '''
-            for ii in i:
-                if not ii:
-                    continue
-
-                for agent_i, values in ii.items():
-                    for name, stat in unroll_nested_dict(values):
-                        infos[name].append(stat)
-                        try:
-                            stat = float(stat)
-                            stats[name].append(stat)
-                        except:
-                            continue
-            '''
-
-            for policy_name, policy_i in i.items():
-                for agent_i in policy_i:
-                    if not agent_i:
-                        continue
+    def _finish_rollout(self, rollout):
+        data, counts, stats = rollout.data, rollout.counts, rollout.stats
+        progress_bar, rollout_time = rollout.progress_bar, rollout.time
+        profiler = self.profiler
+        self.rollout_sps = int(counts.ptr / rollout_time)
+        self.train_data = data
 
-                    for name, stat in unroll_nested_dict(agent_i):
-                        infos[policy_name][name].append(stat)
-                        if 'Task_eval_fn' in name:
-                            # Temporary hack for NMMO competition
-                            continue
-                        try:
-                            stat = float(stat)
-                            stats[policy_name][name].append(stat)
-                        except:
-                            continue
+        agent_steps_collected = counts.agent_steps
+        padded_steps_collected = counts.padded_steps
+        env_step_time = profiler.total("recv") + profiler.total("send")
+        inference_time = profiler.total("inference")
 
         if self.policy_pool.scores and self.policy_ranker is not None:
           self.policy_ranker.update_ranks(
@@ -396,7 +530,7 @@ class CleanPuffeRL:
               wandb_policies=[self.policy_pool._learner_name]
               if self.wandb_entity
               else [],
-              step=self.global_step,
+              step=self.total_global_step,
           )
           self.policy_pool.scores = {}
 
@@ -410,47 +544,65 @@ class CleanPuffeRL:
                     f"Env SPS: {env_sps}",
                     f"Inference SPS: {inference_sps}",
                     f"Agent Steps: {agent_steps_collected}",
-                    *[f"{k}: {np.mean(v):.2f}" for k, v in stats['learner'].items()],
+                    *[f"{k}: {v:.2f}" for k, v in stats.means('learner').items()],
                 ]
             )
         )
 
         self.global_step += self.batch_size
+        staging_allocations = self.staging_stats["allocations"] - rollout.staging_allocations
+
+        latency = profiler.summary()
+        if self.performance_sink is not None:
+            self.performance_sink.write({
+                "update": self.update,
+                "global_step": self.total_global_step,
+                "env_sps": env_sps,
+                "inference_sps": inference_sps,
+                "rollout_sps": self.rollout_sps,
+                **latency,
+            })
 
         if self.wandb_entity:
             wandb.log(
                 {
+                    "performance/trajectory_overflow": data.overflow,
+                    "performance/staging_allocations": staging_allocations,
+                    "performance/staging_mb": self.staging_stats["allocated_bytes"] / 1e6,
                     "performance/env_time": env_step_time,
                     "performance/env_sps": env_sps,
                     "performance/inference_time": inference_time,
                     "performance/inference_sps": inference_sps,
-                    **{
-                        f"performance/env/{k}": np.mean(v)
-                        for k, v in performance.items()
-                    },
-                    **{f"charts/{k}": np.mean(v) for k, v in stats['learner'].items()},
+                    "performance/inference_rows": counts.inference_rows,
+                    "performance/rollout_time": rollout_time,
+                    "performance/rollout_sps": self.rollout_sps,
+                    **{f"performance/{k}": v for k, v in latency.items()},
+                    **{f"charts/{k}": v for k, v in stats.means('learner').items()},
                     "charts/reward": float(torch.mean(data.rewards)),
-                    "agent_steps": self.global_step,
-                    "global_step": self.global_step,
+                    "agent_steps": self.total_global_step,
+                    "global_step": self.total_global_step,
                 }
             )
 
-        allocated_torch = torch.cuda.memory_allocated(self.device) - allocated_torch
-        allocated_cpu = self.process.memory_info().rss - allocated_cpu
+        allocated_torch = torch.cuda.memory_allocated(self.device) - rollout.allocated_torch
+        allocated_cpu = self.process.memory_info().rss - rollout.allocated_cpu
         if self.verbose:
             print(
-                "Allocated during evaluation - Pytorch: %.2f GB, System: %.2f GB"
-                % (allocated_torch / 1e9, allocated_cpu / 1e9)
+                "Allocated during evaluation - Pytorch: %.2f GB, System: %.2f GB, "
+                "Staging tensors: %d"
+                % (allocated_torch / 1e9, allocated_cpu / 1e9, staging_allocations)
             )
 
         uptime = timedelta(seconds=int(time.time() - self.start_time))
         print(
-            f"Epoch: {self.update} - {self.global_step // 1000}K steps - {uptime} Elapsed\n"
-            f"\tSteps Per Second: Env={env_sps}, Inference={inference_sps}"
+            f"Epoch: {self.update} - {self.total_global_step // 1000}K steps - {uptime} Elapsed\n"
+            f"\tSteps Per Second: Env={env_sps}, Inference={inference_sps}, "
+            f"Rollout={self.rollout_sps}"
         )
 
         progress_bar.close()
-        return data, stats, infos
+        # Raw values are only kept for the retained keys (team_results, curriculum)
+        return data, stats.summary(), stats.retained
 
     @pufferlib.utils.profile
     def train(
@@ -468,6 +620,7 @@ class CleanPuffeRL:
         vf_coef=0.5,
         max_grad_norm=0.5,
         target_kl=None,
+        grad_accumulation_steps=1,
     ):
         if self.done_training():
             raise RuntimeError(
@@ -484,38 +637,47 @@ class CleanPuffeRL:
             lrnow = frac * self.learning_rate
             self.optimizer.param_groups[0]["lr"] = lrnow
 
-        # Sort here
-        data = self.data
-        idxs = sorted(range(len(data.sort_keys)), key=data.sort_keys.__getitem__)
-        data.sort_keys = []
+        # Order samples by (buffer, env, agent, step)
+        data = self.train_data
+        policy_lag = self.update - data.policy_version
+        idxs = self._trajectory_order(data)
+        self.clear_rollout(data)
 
+        if self.batch_size % (bptt_horizon * batch_rows) != 0:
+            raise ValueError(
+                f"batch_size={self.batch_size} must be divisible by "
+                f"bptt_horizon * batch_rows = {bptt_horizon} * {batch_rows}"
+            )
+        if batch_rows % grad_accumulation_steps != 0:
+            raise ValueError(
+                f"batch_rows={batch_rows} must be divisible by "
+                f"grad_accumulation_steps={grad_accumulation_steps}"
+            )
         num_minibatches = self.batch_size // bptt_horizon // batch_rows
+        micro_rows = batch_rows // grad_accumulation_steps
         b_idxs = (
-            torch.Tensor(idxs)
-            .long()[:-1]
+            torch.as_tensor(idxs, dtype=torch.long)[:-1]
             .reshape(batch_rows, num_minibatches, bptt_horizon)
             .transpose(0, 1)
         )
 
         # bootstrap value if not done
         with torch.no_grad():
-            advantages = torch.zeros(self.batch_size, device=self.device)
-            lastgaelam = 0
-            for t in reversed(range(self.batch_size)):
-                i, i_nxt = idxs[t], idxs[t + 1]
-                nextnonterminal = 1.0 - data.dones[i_nxt]
-                nextvalues = data.values[i_nxt]
-                delta = (
-                    data.rewards[i_nxt]
-                    + gamma * nextvalues * nextnonterminal
-                    - data.values[i]
-                )
-                advantages[t] = lastgaelam = (
-                    delta + gamma * gae_lambda * nextnonterminal * lastgaelam
-                )
-
-        # Flatten the batch
-        data.b_obs = b_obs = data.obs[b_idxs]
+            advantages = compute_gae(
+                data.values, data.dones, data.rewards, idxs, gamma, gae_lambda)
+
+        # Flatten the batch. Compressed observations stay compressed until
+        # each minibatch is moved to the device. Lazily gathered and
+        # memory-mapped observations are not flattened: each minibatch is
+        # read in BPTT order, and memory-mapped files prefetch the next one
+        allocator = data.allocator
+        lazy_obs = self.lazy_obs_gather or allocator is not None
+        if lazy_obs:
+            b_obs = None
+        elif self.compress_obs:
+            data.b_obs = b_obs = data.obs.select(b_idxs)
+        else:
+            data.b_obs = b_obs = data.obs[b_idxs]
         b_actions = data.actions[b_idxs]
         b_logprobs = data.logprobs[b_idxs]
         b_dones = data.dones[b_idxs]
@@ -525,112 +687,182 @@ class CleanPuffeRL:
         ).transpose(0, 1)
         b_returns = b_advantages + b_values
 
+        def load_obs(mb):
+            if lazy_obs:
+                if allocator is not None:
+                    allocator.prefetch(b_idxs[(mb + 1) % num_minibatches].numpy())
+                mb_obs = data.obs[b_idxs[mb]]
+            else:
+                mb_obs = b_obs[mb]
+            if self.prefetch_depth and self.pin_staging and mb_obs.device.type == "cpu":
+                mb_obs = mb_obs.pin_memory()
+            return mb_obs.to(self.device, non_blocking=bool(self.prefetch_depth))
+
         # Optimizing the policy and value network
         train_time = time.time()
+        loader = prefetch.MinibatchPrefetcher(
+            load_obs,
+            [mb for _ in range(update_epochs) for mb in range(num_minibatches)],
+            self.prefetch_depth,
+        )
         clipfracs = []
         for epoch in range(update_epochs):
             lstm_state = None
             for mb in range(num_minibatches):
-                mb_obs = b_obs[mb].to(self.device)
+                mb_obs = loader.next()
                 mb_actions = b_actions[mb].contiguous()
-                mb_values = b_values[mb].reshape(-1)
-                mb_advantages = b_advantages[mb].reshape(-1)
-                mb_returns = b_returns[mb].reshape(-1)
-
-                if self.agent.is_recurrent:
-                    (
-                        _,
-                        newlogprob,
-                        entropy,
-                        newvalue,
-                        lstm_state,
-                    ) = self.agent.get_action_and_value(
-                        mb_obs, state=lstm_state, done=b_dones[mb], action=mb_actions
-                    )
-                    lstm_state = (lstm_state[0].detach(), lstm_state[1].detach())
-                else:
-                    _, newlogprob, entropy, newvalue = self.agent.get_action_and_value(
-                        mb_obs.reshape(
-                            -1, *self.buffers[0].single_observation_space.shape
-                        ),
-                        action=mb_actions,
-                    )
-
-                logratio = newlogprob - b_logprobs[mb].reshape(-1)
-                ratio = logratio.exp()
-
-                with torch.no_grad():
-                    # calculate approx_kl http://joschu.net/blog/kl-approx.html
-                    old_approx_kl = (-logratio).mean()
-                    approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs += [
-                        ((ratio - 1.0).abs() > clip_coef).float().mean().item()
-                    ]
+                mb_logprobs = b_logprobs[mb]
+                mb_values = b_values[mb]
+                mb_returns = b_returns[mb]
 
-                mb_advantages = mb_advantages.reshape(-1)
+                # Normalize over the whole minibatch, not per micro-batch
+                mb_advantages = b_advantages[mb]
                 if norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (
-                        mb_advantages.std() + 1e-8
+                    if self.distributed:
+                        adv_mean, adv_std = distributed.mean_std(mb_advantages)
+                    else:
+                        adv_mean, adv_std = mb_advantages.mean(), mb_advantages.std()
+                    mb_advantages = (mb_advantages - adv_mean) / (adv_std + 1e-8)
+
+                # Forward and backward micro-batches of rows, then take a
+                # single optimizer step for the minibatch
+                self.optimizer.zero_grad()
+                metrics = torch.zeros(5, device=self.device)
+                next_lstm_state = []
+                for micro in range(grad_accumulation_steps):
+                    rows = slice(micro * micro_rows, (micro + 1) * micro_rows)
+                    micro_actions = mb_actions[rows]
+
+                    with self._autocast():
+                        if self.agent.is_recurrent:
+                            micro_state = None
+                            if lstm_state is not None:
+                                micro_state = (lstm_state[0][:, rows], lstm_state[1][:, rows])
+                            (
+                                _,
+                                newlogprob,
+                                entropy,
+                                newvalue,
+                                micro_state,
+                            ) = self.agent.get_action_and_value(
+                                mb_obs[rows],
+                                state=micro_state,
+                                done=b_dones[mb][rows],
+                                action=micro_actions,
+                            )
+                            next_lstm_state.append(micro_state)
+                        else:
+                            _, newlogprob, entropy, newvalue = self.agent.get_action_and_value(
+                                mb_obs[rows].reshape(
+                                    -1, *self.buffers[0].single_observation_space.shape
+                                ),
+                                action=micro_actions,
+                            )
+
+                    # The loss and its reductions stay in fp32
+                    newlogprob, entropy, newvalue = (
+                        newlogprob.float(), entropy.float(), newvalue.float())
+
+                    logratio = newlogprob - mb_logprobs[rows].reshape(-1)
+                    ratio = logratio.exp()
+
+                    with torch.no_grad():
+                        # calculate approx_kl http://joschu.net/blog/kl-approx.html
+                        old_approx_kl = (-logratio).mean()
+                        approx_kl = ((ratio - 1) - logratio).mean()
+                        clipfrac = ((ratio - 1.0).abs() > clip_coef).float().mean()
+
+                    micro_advantages = mb_advantages[rows].reshape(-1)
+                    micro_values = mb_values[rows].reshape(-1)
+                    micro_returns = mb_returns[rows].reshape(-1)
+
+                    # Policy loss
+                    pg_loss1 = -micro_advantages * ratio
+                    pg_loss2 = -micro_advantages * torch.clamp(
+                        ratio, 1 - clip_coef, 1 + clip_coef
                     )
-
-                # Policy loss
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(
-                    ratio, 1 - clip_coef, 1 + clip_coef
-                )
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-
-                # Value loss
-                newvalue = newvalue.view(-1)
-                if clip_vloss:
-                    v_loss_unclipped = (newvalue - mb_returns) ** 2
-                    v_clipped = mb_values + torch.clamp(
-                        newvalue - mb_values,
-                        -clip_coef,
-                        clip_coef,
+                    pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+
+                    # Value loss
+                    newvalue = newvalue.view(-1)
+                    if clip_vloss:
+                        v_loss_unclipped = (newvalue - micro_returns) ** 2
+                        v_clipped = micro_values + torch.clamp(
+                            newvalue - micro_values,
+                            -clip_coef,
+                            clip_coef,
+                        )
+                        v_loss_clipped = (v_clipped - micro_returns) ** 2
+                        v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+                        v_loss = 0.5 * v_loss_max.mean()
+                    else:
+                        v_loss = 0.5 * ((newvalue - micro_returns) ** 2).mean()
+
+                    entropy_loss = entropy.mean()
+                    loss = pg_loss - ent_coef * entropy_loss + v_loss * vf_coef
+
+                    # Micro-batches are equal sized, so averaging their
+                    # losses gives the minibatch loss
+                    (loss / grad_accumulation_steps).backward()
+                    metrics += torch.stack([
+                        pg_loss.detach(), v_loss.detach(), entropy_loss.detach(),
+                        old_approx_kl, approx_kl,
+                    ]) / grad_accumulation_steps
+                    clipfracs.append(clipfrac)
+
+                pg_loss, v_loss, entropy_loss, old_approx_kl, approx_kl = metrics
+                if next_lstm_state:
+                    lstm_state = (
+                        torch.cat([h for h, _ in next_lstm_state], dim=1).detach(),
+                        torch.cat([c for _, c in next_lstm_state], dim=1).detach(),
                     )
-                    v_loss_clipped = (v_clipped - mb_returns) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 * ((newvalue - mb_returns) ** 2).mean()
-
-                entropy_loss = entropy.mean()
-                loss = pg_loss - ent_coef * entropy_loss + v_loss * vf_coef
-
-                if self.record_loss:
-                    with open(self.loss_file, "a") as f:
-                        print(f"# mini batch ({epoch}, {mb}) -- pg_loss:{pg_loss.item():.4f}, value_loss:{v_loss.item():.4f}, " + \
-                              f"entropy:{entropy_loss.item():.4f}, approx_kl: {approx_kl.item():.4f}",
-                                file=f)
-                    with open(self.action_file, "a") as f:
-                        print(f"# mini batch ({epoch}, {mb}) -- pg_loss:{pg_loss.item():.4f}, value_loss:{v_loss.item():.4f}, " + \
-                              f"entropy:{entropy_loss.item():.4f}, approx_kl: {approx_kl.item():.4f}",
-                                file=f)
-                        atn_list = mb_actions.cpu().numpy().tolist()
-                        for atns in atn_list:
-                            for atn in atns:
-                                print(f"{atn}", file=f)
 
-                self.optimizer.zero_grad()
-                loss.backward()
+                if self.loss_recorder is not None:
+                    self.loss_recorder.record_minibatch(epoch, mb, metrics, mb_actions)
+
+                if self.distributed:
+                    distributed.all_reduce_gradients(self.agent.parameters())
                 nn.utils.clip_grad_norm_(self.agent.parameters(), max_grad_norm)
                 self.optimizer.step()
 
+            if self.loss_recorder is not None:
+                self.loss_recorder.end_epoch(self.update, epoch)
+
             if target_kl is not None:
+                # Every learner has to stop after the same epoch
+                if self.distributed:
+                    approx_kl = distributed.all_reduce_mean(approx_kl)
                 if approx_kl > target_kl:
                     break
 
+        # Free the reordered observations before the next rollout
+        loader.close()
+        data.b_obs = b_obs = None
+
+        clipfrac = torch.stack(clipfracs).mean().item()
         y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
         var_y = np.var(y_true)
         explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
 
+        if self.loss_recorder is not None:
+            self.loss_recorder.record_update(
+                self.update,
+                pg_loss=pg_loss.item(),
+                v_loss=v_loss.item(),
+                entropy=entropy_loss.item(),
+                approx_kl=approx_kl.item(),
+                clipfrac=clipfrac,
+                explained_var=explained_var,
+            )
+
         # TIMING: performance metrics to evaluate cpu/gpu usage
         train_time = time.time() - train_time
         train_sps = int(self.batch_size / train_time)
+        data_wait_time = loader.wait_time
         self.update += 1
 
-        print(f"\tTrain={train_sps}\n")
+        print(f"\tTrain={train_sps}, Data wait={data_wait_time:.2f}s, "
+              f"Compute={train_time - data_wait_time:.2f}s\n")
 
         allocated_torch = torch.cuda.memory_allocated(self.device) - allocated_torch
         allocated_cpu = self.process.memory_info().rss - allocated_cpu
@@ -640,52 +872,517 @@ class CleanPuffeRL:
                 % (allocated_torch / 1e9, allocated_cpu / 1e9)
             )
 
-        if self.record_loss:
-            with open(self.loss_file, "a") as f:
-                print(f"Epoch -- policy_loss:{pg_loss.item():.4f}, value_loss:{v_loss.item():.4f}, ",
-                      f"entropy:{entropy_loss.item():.4f}, approx_kl:{approx_kl.item():.4f}",
-                      f"clipfrac:{np.mean(clipfracs):.4f}, explained_var:{explained_var:.4f}",
-                      file=f)
-
         # TRY NOT TO MODIFY: record rewards for plotting purposes
         if self.wandb_entity:
             wandb.log(
                 {
                     "performance/train_sps": train_sps,
                     "performance/train_time": train_time,
+                    "performance/data_wait_time": data_wait_time,
+                    "performance/train_compute_time": train_time - data_wait_time,
                     "charts/learning_rate": self.optimizer.param_groups[0]["lr"],
+                    "charts/policy_lag": policy_lag,
                     "losses/value_loss": v_loss.item(),
                     "losses/policy_loss": pg_loss.item(),
                     "losses/entropy": entropy_loss.item(),
                     "losses/old_approx_kl": old_approx_kl.item(),
                     "losses/approx_kl": approx_kl.item(),
-                    "losses/clipfrac": np.mean(clipfracs),
+                    "losses/clipfrac": clipfrac,
                     "losses/explained_variance": explained_var,
-                    "agent_steps": self.global_step,
-                    "global_step": self.global_step,
+                    "agent_steps": self.total_global_step,
+                    "global_step": self.total_global_step,
                 }
             )
 
+        if allocator is not None:
+            allocator.release()
+
         if self.update % self.checkpoint_interval == 1 or self.done_training():
            self._save_checkpoint()
 
+    def _rollout_serial(self, counts, stats, progress_bar):
+        '''recv -> inference -> send -> storage, one buffer at a time'''
+        data = self.data
+        compact = self.compact_inference and self._can_compact_inference()
+        while counts.ptr < self.batch_size + 1 and not counts.cancelled:
+            buf = data.buf
+            counts.step += 1
+
+            step = self._recv(buf, counts)
+            self._infer_and_send(step, compact, counts)
+            data.buf = (data.buf + 1) % self.num_buffers
+            self._consume(step, counts, stats, progress_bar)
+
+    def _rollout_pipelined(self, counts, stats, progress_bar):
+        '''Overlap env recv, inference and storage across buffers
+
+        A receiver thread recvs buffers in turn and stages their outputs, the
+        calling thread runs inference and sends actions, and a consumer
+        thread scatters samples into storage and aggregates infos. Bounded
+        queues of pipeline_depth steps connect the three. A buffer is recv'd
+        again only after its previous step has been consumed, because its
+        staging tensors are reused.
+
+        Every step that was recv'd is also sent, so steps in flight when the
+        batch fills are still stepped but not stored.
+        '''
+        data = self.data
+        compact = self.compact_inference and self._can_compact_inference()
+        received = queue.Queue(maxsize=self.pipeline_depth)
+        inferred = queue.Queue(maxsize=self.pipeline_depth)
+        consumed = [threading.Semaphore(1) for _ in range(self.num_buffers)]
+        full = threading.Event()
+        errors = []
+
+        def receiver():
+            try:
+                while not full.is_set() and not counts.cancelled:
+                    buf = data.buf
+                    while not consumed[buf].acquire(timeout=0.01):
+                        if full.is_set() or counts.cancelled:
+                            return
+
+                    counts.step += 1
+                    received.put(self._recv(buf, counts))
+                    data.buf = (data.buf + 1) % self.num_buffers
+            except Exception as e:
+                errors.append(e)
+                full.set()
+            finally:
+                received.put(None)
+
+        def consumer():
+            while True:
+                step = inferred.get()
+                if step is None:
+                    return
+
+                try:
+                    if not errors and counts.ptr < self.batch_size + 1:
+                        self._consume(step, counts, stats, progress_bar)
+                        if counts.ptr == self.batch_size + 1:
+                            full.set()
+                except Exception as e:
+                    errors.append(e)
+                    full.set()
+                consumed[step.buf].release()
+
+        threads = [threading.Thread(target=receiver, daemon=True),
+                   threading.Thread(target=consumer, daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        step = None
+        try:
+            while True:
+                step = received.get()
+                if step is None:
+                    break
+                self._infer_and_send(step, compact, counts)
+                # The policy pool reuses its output tensors, and the consumer
+                # may read these after the next inference has overwritten them
+                step.actions, step.logprob, step.value = (
+                    step.actions.clone(), step.logprob.clone(), step.value.clone())
+                inferred.put(step)
+        finally:
+            if step is not None:
+                # Inference failed. Unblock the receiver before joining
+                full.set()
+                while received.get() is not None:
+                    pass
+            inferred.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def _recv(self, buf, counts):
+        '''Receive and stage one step of buffer `buf`'''
+        with self.profiler.stage("recv", f"buf{buf}"):
+            o, r, d, i = self.buffers[buf].recv()
+
+        i = self.policy_pool.update_scores(i, "return")
+
+        if self.profile_workers:
+            for worker, timings in enumerate(self.buffers[buf].profile()):
+                for name, seconds in timings.items():
+                    self.profiler.record(f"env/{name}", seconds, f"worker{worker}")
+
+        o, o_device, r, d, alive_mask = self._preprocess(buf, o, r, d)
+        counts.agent_steps += int(alive_mask.sum())
+        counts.padded_steps += len(alive_mask)
+        return SimpleNamespace(buf=buf, step=counts.step, o=o, o_device=o_device,
+                               r=r, d=d, alive_mask=alive_mask, infos=i)
+
+    def _infer_and_send(self, step, compact, counts):
+        '''Compute actions for a received step and send them to its buffer'''
+        data, buf = self.data, step.buf
+        scope = f"buf{buf}"
+
+        # ALGO LOGIC: action logic
+        with self.profiler.stage("inference", scope), torch.no_grad(), self._autocast():
+            if compact:
+                actions, logprob, value = self._compact_forward(
+                    step.o_device, step.alive_mask)
+                counts.inference_rows += int(step.alive_mask.sum())
+            else:
+                (
+                    actions,
+                    logprob,
+                    value,
+                    data.next_lstm_state[buf],
+                ) = self.policy_pool.forwards(
+                    step.o_device,
+                    data.next_lstm_state[buf],
+                    data.next_done[buf],
+                )
+                counts.inference_rows += len(step.o_device)
+            step.value = value.flatten().float()
+            step.actions, step.logprob = actions, logprob.float()
+            actions = actions.cpu().numpy()
+
+        # TRY NOT TO MODIFY: execute the game
+        with self.profiler.stage("send", scope):
+            self.buffers[buf].send(actions, None)
+
+    def _consume(self, step, counts, stats, progress_bar):
+        '''Store the samples of an inferred step and aggregate its infos'''
+        scope = f"buf{step.buf}"
+
+        # Index alive mask with policy pool idxs...
+        # TODO: Find a way to avoid having to do this
+        alive_mask = step.alive_mask
+        if self.selfplay_learner_weight > 0:
+          alive_mask = np.array(alive_mask) * self.policy_pool.learner_mask
+
+        data = self.data
+        with self.profiler.stage("storage", scope):
+            overflow = data.overflow
+            stored = self._store(
+                data, step.buf, step.step, counts.ptr, alive_mask, step.o,
+                step.r, step.d, step.actions, step.logprob, step.value)
+        progress_bar.update(stored)
+        counts.ptr += stored
+        if data.horizon:
+            self._check_trajectory_capacity(counts, step.buf, stored, data.overflow > overflow)
+
+        with self.profiler.stage("infos", scope):
+            for policy_name, policy_i in step.infos.items():
+                for agent_i in policy_i:
+                    if not agent_i:
+                        continue
+
+                    for name, stat in unroll_nested_dict(agent_i):
+                        stats.add(policy_name, name, stat)
+
+    def _preprocess(self, buf, o, r, d):
+        '''Stage recv() outputs and compute the alive mask
+
+        Returns the observations used for storage, the observations on the
+        device, rewards, dones and the alive mask.
+        '''
+        profiler, scope = self.profiler, f"buf{buf}"
+        data = self.data
+
+        # Copy into reusable staging tensors instead of allocating
+        with profiler.stage("convert", scope):
+            o_host = self._stage(buf, "obs", o)
+            r_host = self._stage(buf, "rewards", r)
+
+            if len(d) != 0 and len(data.next_done[buf]) != 0:
+                d = self._stage(buf, "dones", d).view(-1)
+                last_done = self._stage(buf, "last_dones", None, d.shape)
+                alive_mask = ((last_done + d) != 2).numpy()
+                last_done.copy_(d)
+                has_dones = True
+            else:
+                alive_mask = np.ones(len(o_host), dtype=bool)
+                has_dones = False
+
+        with profiler.stage("h2d", scope):
+            o_device = self._stage_device(buf, "obs", o_host)
+            r = self._stage_device(buf, "rewards", r_host).view(-1)
+            if has_dones:
+                data.next_done[buf].copy_(d, non_blocking=True)
+
+        o = o_host if self.cpu_offload else o_device
+        return o, o_device, r, d, alive_mask
+
+    def _store(self, data, buf, step, ptr, alive_mask, o, r, d, actions, logprob, value):
+        '''Write the stored rows of one step at once, respecting the
+        batch_size + 1 cutoff. Returns the number of rows written'''
+        idxs = np.where(alive_mask)[0]
+        if data.horizon:
+            slots = buf * self.num_envs * self.num_agents + idxs
+            cursor = data.slot_cursor[slots]
+            full = cursor >= data.horizon
+            data.overflow += int(full.sum())
+            idxs, slots, cursor = idxs[~full], slots[~full], cursor[~full]
+
+        idxs = idxs[:self.batch_size + 1 - ptr]
+        if len(idxs) == 0:
+            return 0
+
+        if data.horizon:
+            slots, cursor = slots[:len(idxs)], cursor[:len(idxs)]
+            rows = torch.as_tensor(slots * data.horizon + cursor)
+            data.slot_cursor[slots] += 1
+        else:
+            rows = slice(ptr, ptr + len(idxs))
+            data.sort_keys.extend((buf, idx, step) for idx in idxs.tolist())
+
+        idxs_t = torch.as_tensor(idxs, dtype=torch.long)
+        obs_rows = rows.to(data.obs.device) if data.horizon else rows
+        data.obs[obs_rows] = o[idxs_t.to(o.device)].to(data.obs.device)
+
+        idxs_t = idxs_t.to(self.device)
+        if data.horizon:
+            rows = rows.to(self.device)
+        data.values[rows] = value[idxs_t]
+        data.actions[rows] = actions[idxs_t]
+        data.logprobs[rows] = logprob[idxs_t]
+
+        if len(d) != 0:
+            data.rewards[rows] = r[idxs_t]
+            data.dones[rows] = d[torch.as_tensor(idxs)].to(self.device)
+
+        return len(idxs)
+
+    def _check_trajectory_capacity(self, counts, buf, stored, overflowed):
+        '''Raise once the batch can no longer fill in trajectory storage
+
+        A buffer is full when a step stored nothing and dropped rows of
+        agents whose slots reached the horizon. Once every buffer is full,
+        the remaining rows would belong to slots that are dead or not
+        learners, so the rollout would never end.
+        '''
+        if stored:
+            counts.full_buffers.discard(buf)
+        elif overflowed:
+            counts.full_buffers.add(buf)
+
+        if len(counts.full_buffers) == self.num_buffers and counts.ptr < self.batch_size + 1:
+            raise RuntimeError(
+                f"Every live trajectory slot is full after {counts.ptr} of "
+                f"{self.batch_size + 1} samples; increase trajectory_horizon"
+            )
+
+    def _can_compact_inference(self):
+        return self.selfplay_num_policies == 1 and not self.agent.is_recurrent
+
+    def _compact_forward(self, obs, alive_mask):
+        '''Run the learner on live rows only and scatter the outputs back
+
+        Dead and padded rows get zero actions, which the environment
+        discards, and zero logprobs and values, which are never stored.
+        '''
+        rows = len(obs)
+        live = torch.as_tensor(np.flatnonzero(alive_mask), device=obs.device)
+        action_shape = self.buffers[0].single_action_space.shape
+        actions = torch.zeros((rows, *action_shape), dtype=torch.long, device=obs.device)
+        logprob = torch.zeros(rows, device=obs.device)
+        value = torch.zeros(rows, device=obs.device)
+        if len(live) == 0:
+            return actions, logprob, value
+
+        live_actions, live_logprob, _, live_value = self.actor.get_action_and_value(obs[live])
+        actions[live] = live_actions.view(len(live), *action_shape).to(actions.dtype)
+        logprob[live] = live_logprob.float()
+        value[live] = live_value.flatten().float()
+        return actions, logprob, value
+
+    def _allocate_rollout(self, num_rows, horizon, num_slots, index):
+        '''Sample storage of one rollout, without the env stream state'''
+        allocator = None
+        if self.storage_backend == "mmap":
+            name = "rollout" if index == 0 else f"rollout{index}"
+            allocator = storage.MemmapAllocator(
+                os.path.join(self.data_dir, self._rank_path(name)))
+
+        return SimpleNamespace(
+            sort_keys=[],
+            horizon=horizon,
+            slot_cursor=np.zeros(num_slots if horizon else 0, dtype=np.int64),
+            overflow=0,
+            policy_version=self.update,
+            allocator=allocator,
+            obs=self._allocate_obs(num_rows, allocator),
+            actions=torch.zeros(
+                num_rows, *self.buffers[0].single_action_space.shape, dtype=int
+            ).to(self.device),
+            logprobs=torch.zeros(num_rows).to(self.device),
+            rewards=torch.zeros(num_rows).to(self.device),
+            dones=torch.zeros(num_rows).to(self.device),
+            values=torch.zeros(num_rows).to(self.device),
+        )
+
+    def _allocate_obs(self, num_rows, allocator=None):
+        device = "cpu" if self.cpu_offload else self.device
+        obs_shape = self.buffers[0].single_observation_space.shape
+        zeros = None
+        if allocator is not None:
+            zeros = allocator.zeros
+
+        if not self.compress_obs:
+            if zeros is not None:
+                return zeros("obs", (num_rows, *obs_shape), torch.float32)
+            return torch.zeros(num_rows, *obs_shape).to(device)
+
+        obs = storage.CompressedObservations.allocate(
+            num_rows, self.buffers[0].driver_env.flat_observation_space, device, zeros)
+        assert obs.shape == (num_rows, *obs_shape), \
+            "flat_observation_space does not match the flat observation size"
+        if self.verbose:
+            print(
+                "Compressed observation storage: %.2f GB (float32: %.2f GB)"
+                % (obs.nbytes / 1e9, num_rows * np.prod(obs_shape) * 4 / 1e9)
+            )
+        return obs
+
+    def _stage(self, buf, name, array, shape=None):
+        '''Copy a recv() output into the host staging tensor `name` of buffer `buf`
+
+        The staging tensor is (re)allocated only when the shape changes, so a
+        steady-state rollout allocates no new host memory per step. With
+        array=None, returns a zero-initialized tensor of the given shape.
+        '''
+        if array is not None:
+            array = np.asarray(array)
+            shape = array.shape
+
+        staging = self.staging[buf]
+        host = staging.get(name)
+        if host is None or host.shape != shape:
+            host = torch.zeros(shape, dtype=torch.float32)
+            if self.pin_staging:
+                host = host.pin_memory()
+            staging[name] = host
+            self.staging_stats["allocations"] += 1
+            self.staging_stats["allocated_bytes"] += host.numel() * host.element_size()
+
+        if array is not None:
+            host.copy_(torch.from_numpy(array))
+            self.staging_stats["copies"] += 1
+        return host
+
+    def _stage_device(self, buf, name, host):
+        '''Reusable device-side copy of a host staging tensor'''
+        if torch.device(self.device).type == "cpu":
+            return host
+
+        staging = self.staging[buf]
+        key = name + "_device"
+        device = staging.get(key)
+        if device is None or device.shape != host.shape:
+            device = torch.empty_like(host, device=self.device)
+            staging[key] = device
+        return device.copy_(host, non_blocking=True)
+
+    def _autocast(self, precision=None):
+        '''Mixed-precision context for policy forwards; disabled in fp32'''
+        return torch.autocast(
+            torch.device(self.device).type,
+            dtype=torch.bfloat16,
+            enabled=(precision or self.precision) == "bf16",
+        )
+
+    def precision_parity(self, num_rows=4096):
+        '''Learner outputs under bf16 autocast versus fp32 on the stored rollout
+
+        Call after evaluate(). Returns the max and mean absolute difference
+        of the logprobs, entropies and values of the rollout's own actions.
+        '''
+        assert not self.agent.is_recurrent, "Parity is checked on feedforward policies"
+        data = self.train_data
+        rows = torch.as_tensor(self._trajectory_order(data)[:num_rows], dtype=torch.long)
+        obs = data.obs[rows].to(self.device)
+        actions = data.actions[rows.to(data.actions.device)]
+
+        outputs = {}
+        with torch.no_grad():
+            for precision in ("fp32", "bf16"):
+                with self._autocast(precision):
+                    _, logprob, entropy, value = self.agent.get_action_and_value(
+                        obs, action=actions)
+                outputs[precision] = {
+                    "logprob": logprob.float(),
+                    "entropy": entropy.float(),
+                    "value": value.float().flatten(),
+                }
+
+        report = {"rows": len(rows)}
+        for name, reference in outputs["fp32"].items():
+            error = (outputs["bf16"][name] - reference).abs()
+            report[f"{name}/max_abs_diff"] = error.max().item()
+            report[f"{name}/mean_abs_diff"] = error.mean().item()
+        return report
+
+    def allocation_stats(self):
+        '''Staging tensor allocations since startup, plus process memory'''
+        return {
+            **self.staging_stats,
+            "rss_bytes": self.process.memory_info().rss,
+            "torch_allocated_bytes": torch.cuda.memory_allocated(self.device),
+        }
+
+    def clear_rollout(self, data=None):
+        '''Discard the sample ordering of a rollout, by default the current one'''
+        data = data or self.data
+        data.sort_keys = []
+        data.slot_cursor[:] = 0
+        data.overflow = 0
+
+    def _trajectory_order(self, data=None):
+        '''Storage rows of the rollout, grouped by agent slot in step order'''
+        data = data or self.data
+        if not data.horizon:
+            return sorted(range(len(data.sort_keys)), key=data.sort_keys.__getitem__)
+
+        # Row-major over [slots, horizon], so the filled prefix of each slot
+        # is already in (buffer, env, agent, step) order
+        filled = np.arange(data.horizon)[None, :] < data.slot_cursor[:, None]
+        return np.flatnonzero(filled).tolist()
+
+    @property
+    def total_global_step(self):
+        '''Samples collected by all learners; global_step counts this learner's'''
+        return self.global_step * self.world_size
+
     def done_training(self):
         return self.update >= self.total_updates
 
     def close(self):
+        if self._async_rollout is not None:
+            self._async_rollout.counts.cancelled = True
+            self._async_rollout.thread.join()
+            self._async_rollout = None
+
         for envs in self.buffers:
             envs.close()
 
+        if self.loss_recorder is not None:
+            self.loss_recorder.close()
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+            self._rank_checkpoints()
+
         if self.wandb_entity:
             wandb.finish()
 
+    def _rank_path(self, name):
+        '''Per-learner file name under data_dir; rank 0 keeps the plain name'''
+        return name if self.rank == 0 else f"{name}.rank{self.rank}"
+
     def _save_checkpoint(self):
-        if self.data_dir is None:
+        if self.checkpoint_writer is None:
             return
 
+        # Snapshot on the training thread; serialization happens in the writer
         policy_name = f"{self.exp_name}.{self.update:06d}"
         state = {
-            "optimizer_state_dict": self.optimizer.state_dict(),
+            "optimizer_state_dict": checkpoint.to_cpu(self.optimizer.state_dict()),
             "global_step": self.global_step,
             "agent_step": self.agent_step,
             "update": self.update,
@@ -693,15 +1390,15 @@ class CleanPuffeRL:
             "policy_checkpoint_name": policy_name,
             "wandb_run_id": self.wandb_run_id,
         }
-        path = os.path.join(self.data_dir, f"trainer.pt")
-        tmp_path = path + ".tmp"
-        torch.save(state, tmp_path)
-        os.rename(tmp_path, path)
+        state_dict = checkpoint.to_cpu(self.agent.state_dict())
+        self.checkpoint_writer.submit(policy_name, state_dict, state)
+        self._rank_checkpoints()
 
-        # NOTE: as the agent_creator has args internally, the policy args are not passed
-        self.policy_store.add_policy(policy_name, self.agent)
-
-        if self.policy_ranker:
+    def _rank_checkpoints(self):
+        '''Add written checkpoints to the ranker, from the training thread'''
+        if not self.policy_ranker:
+            return
+        for policy_name in self.checkpoint_writer.completed():
             self.policy_ranker.add_policy_copy(
                 policy_name, self.policy_pool._learner_name
             )
@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 import time
 import torch
@@ -9,7 +10,7 @@ class Config:
     # Track to run - options: reinforcement_learning, curriculum_generation
     track = "rl"
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    #record_loss = False  # log all minibatch loss and actions, for debugging
+    record_loss = False  # Record all minibatch losses and actions to npz chunks under the run directory, for debugging
 
     # Trainer Args
     seed = 1
@@ -18,13 +19,29 @@ class Config:
     num_buffers = 2  # Number of buffers to use for training
     rollout_batch_size = 2**15 # Number of steps to rollout
     eval_batch_size = 2**15 # Number of steps to rollout for eval
+    trajectory_storage = False  # Store rollouts as per-agent trajectories instead of sorting samples
+    trajectory_horizon = 0  # Samples per agent slot in trajectory storage, 0 for automatic
+    compress_obs = False  # Store rollout observations in their narrowest lossless dtype
+    compact_inference = False  # Skip policy inference for dead and padded agent rows
+    profile_workers = False  # Collect per-worker env timings (shared memory vecenv only)
+    pipelined_rollout = False  # Overlap env recv, inference and storage across buffers
+    pipeline_depth = 2  # Steps queued between pipelined rollout stages
+    async_rollout = False  # Collect the next batch with a policy snapshot while the current one trains
+    max_policy_lag = 1  # Maximum updates between the rollout policy snapshot and training on its batch
+    lazy_obs_gather = False  # Gather minibatch observations on demand instead of copying the rollout in train()
+    prefetch_depth = 0  # Minibatches prepared on a background thread during PPO updates, 0 to disable
+    storage_backend = "memory"  # "memory" or "mmap" (files under the run directory)
+    precision = "fp32"  # "fp32", or "bf16" for bfloat16 autocast policy forwards
     train_num_steps = 10_000_000  # Number of steps to train
     eval_num_steps = 1_000_000  # Number of steps to evaluate
     checkpoint_interval = 30  # Interval to save models
+    checkpoint_keep_last = 0  # Keep only the newest N policy checkpoints, 0 to keep all
+    checkpoint_keep_every = 0  # Also keep every Mth saved checkpoint, 0 to disable
     run_name = f"nmmo_{time.strftime('%Y%m%d_%H%M%S')}"  # Run name
     runs_dir = "/tmp/runs"  # Directory for runs
     policy_store_dir = None # Policy store directory
     use_serial_vecenv = False  # Use serial vecenv implementation
+    shared_memory_vecenv = False  # Return worker observations through shared memory instead of pipes
     learner_weight = 1.0  # Weight of learner policy
     max_opponent_policies = 0  # Maximum number of opponent policies to train against
     eval_num_policies = 2 # Number of policies to use for evaluation
@@ -36,6 +53,8 @@ class Config:
     bptt_horizon = 8  # Train on this number of steps of a rollout at a time. Used to reduce GPU memory.
     ppo_training_batch_size = 128  # Number of rows in a training batch
     ppo_update_epochs = 3  # Number of update epochs to use for training
+    num_learners = 1  # Data-parallel learner processes (gloo); envs, rollout and minibatch rows are split across them
+    ppo_grad_accumulation_steps = 1  # Micro-batches per training batch, each row split has its own forward/backward
     ppo_learning_rate = 0.00015  # Learning rate
     clip_coef = 0.1  # PPO clip coefficient
 
@@ -62,10 +81,15 @@ class Config:
     hidden_size = 256
     num_lstm_layers = 0  # Number of LSTM layers to use
     task_size = 4096  # Size of task embedding
+    task_index_obs = False  # Observe a task index; the policy looks the embedding up in tasks_path
     encode_task = True  # Encode task
     attend_task = "none"  # Attend task - options: none, pytorch, nikhil
     attentional_decode = True  # Use attentional action decoder
     extra_encoders = True  # Use inventory and market encoders
+    sparse_entity_encoding = False  # Encode only the occupied Entity rows
+    fused_action_decoder = False  # Run the action heads as one linear and one bmm per target family
+    fused_action_distribution = False  # Sample and score all action heads as one padded tensor
+    compile_policy = False  # torch.compile the policy encoder and decoder, falling back to eager
 
     @classmethod
     def asdict(cls):
@@ -73,7 +97,14 @@ class Config:
                 if not callable(getattr(cls, attr)) and not attr.startswith("__")}
 
 def create_config(config_cls):
-    parser = argparse.ArgumentParser()
+    # --config-overrides takes a JSON file of attribute values (for example
+    # from benchmarks/tune_shapes.py) that replace the class defaults.
+    # Arguments given on the command line still take precedence
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument("--config-overrides", type=str, default=None,
+                            help="JSON file of config attribute overrides")
+    overrides_file = pre_parser.parse_known_args()[0].config_overrides
+    parser = argparse.ArgumentParser(parents=[pre_parser])
 
     # Get attribute names and their values from the static class
     attrs = config_cls.asdict()
@@ -91,4 +122,12 @@ def create_config(config_cls):
             help=f"{arg_name} (default: {value})"
         )
 
+    if overrides_file is not None:
+        with open(overrides_file) as f:
+            overrides = json.load(f)
+        unknown = set(overrides) - set(attrs)
+        if unknown:
+            raise ValueError(f"Unknown config attributes in {overrides_file}: {sorted(unknown)}")
+        parser.set_defaults(**overrides)
+
     return parser.parse_args()
@@ -0,0 +1,79 @@
+# Data-parallel learner processes for CleanPuffeRL
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def launch(fn, world_size, *args):
+    '''Run fn(rank, world_size, *args) in world_size local processes
+
+    The processes join a gloo process group over localhost and split the
+    machine's intra-op threads evenly.
+    '''
+    port = _free_port()
+    mp.spawn(_run, args=(world_size, port, fn, args), nprocs=world_size, join=True)
+
+
+def _run(rank, world_size, port, fn, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def broadcast_parameters(module, src=0):
+    '''Copy the parameters and buffers of module on rank src to every rank'''
+    for tensor in [*module.parameters(), *module.buffers()]:
+        dist.broadcast(tensor.data, src)
+
+
+def all_reduce_gradients(parameters):
+    '''Average gradients across ranks, in one flattened all-reduce'''
+    parameters = [p for p in parameters if p.requires_grad]
+    for p in parameters:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    grads = [p.grad for p in parameters]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def all_reduce_mean(tensor):
+    tensor = tensor.detach().clone()
+    dist.all_reduce(tensor)
+    return tensor / dist.get_world_size()
+
+
+def mean_std(tensor):
+    '''Mean and unbiased standard deviation of tensor's values on all ranks'''
+    stats = torch.stack([
+        tensor.sum(),
+        (tensor * tensor).sum(),
+        torch.tensor(float(tensor.numel()), device=tensor.device),
+    ]).detach()
+    dist.all_reduce(stats)
+
+    total, total_sq, count = stats
+    mean = total / count
+    var = (total_sq - count * mean * mean) / (count - 1)
+    return mean, var.clamp(min=0).sqrt()
@@ -0,0 +1,51 @@
+# Action distributions for multi-head policies
+import torch
+import torch.nn.functional as F
+
+
+class FusedMultiDiscrete:
+    '''Independent categorical heads of different widths, packed into one tensor
+
+    The logits of every head are padded to the widest head, giving a
+    [batch, heads, width] tensor, so sampling, log-prob and entropy are single
+    batched ops instead of a loop over heads. Padding is excluded by a width
+    mask and never sampled. It is the lowest finite float rather than -inf,
+    so that 0 * log(0) terms stay finite in backward.
+    '''
+    def __init__(self, logits):
+        widths = [l.shape[-1] for l in logits]
+        width = max(widths)
+        lowest = torch.finfo(torch.float32).min
+        padded = torch.stack(
+            [F.pad(l.float(), (0, width - w), value=lowest)
+             for l, w in zip(logits, widths)],
+            dim=1,
+        )
+        self.mask = (
+            torch.arange(width, device=padded.device)[None, :]
+            < torch.as_tensor(widths, device=padded.device)[:, None]
+        )
+        self.log_probs = padded.log_softmax(dim=-1)
+
+    @property
+    def num_heads(self):
+        return self.log_probs.shape[1]
+
+    def sample(self):
+        '''[batch, heads] actions'''
+        batch, heads, width = self.log_probs.shape
+        probs = self.log_probs.exp().view(batch * heads, width)
+        return torch.multinomial(probs, 1).view(batch, heads)
+
+    def log_prob(self, actions):
+        '''Joint log-prob of [batch, heads] actions, summed over heads'''
+        actions = actions.long().view(-1, self.num_heads, 1)
+        return self.log_probs.gather(-1, actions).squeeze(-1).sum(dim=1)
+
+    def entropy(self):
+        '''Sum of the per-head entropies'''
+        # Clamped like Categorical.entropy, in case logits hold -inf
+        log_probs = self.log_probs.clamp(min=torch.finfo(self.log_probs.dtype).min)
+        plogp = torch.where(
+            self.mask, log_probs.exp() * log_probs, torch.zeros_like(log_probs))
+        return -plogp.sum(dim=(1, 2))
@@ -0,0 +1,109 @@
+# Buffered per-minibatch loss and action recording for CleanPuffeRL.train
+import glob
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+
+METRICS = ("pg_loss", "v_loss", "entropy", "old_approx_kl", "approx_kl")
+
+
+class LossRecorder:
+    '''Buffers minibatch losses and actions and writes them as npz chunks
+
+    Losses stay on the training device until the end of each epoch, when
+    they are copied to the host in one transfer and written together with
+    the epoch's actions by a background thread, as
+    update{update:06d}_epoch{epoch:02d}.npz. Per-update summaries go to
+    update{update:06d}.npz. Use load_records() to read a directory back.
+    '''
+    def __init__(self, directory, max_pending=4):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._minibatches = []
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record_minibatch(self, epoch, minibatch, metrics, actions):
+        '''metrics: tensor of METRICS values, actions: the minibatch actions'''
+        self._minibatches.append((epoch, minibatch, metrics.detach(), actions.detach()))
+
+    def end_epoch(self, update, epoch):
+        if not self._minibatches:
+            return
+
+        epochs, minibatches, metrics, actions = zip(*self._minibatches)
+        self._minibatches = []
+        metrics = torch.stack(metrics).float().cpu().numpy()
+        chunk = {
+            "update": np.full(len(epochs), update, dtype=np.int32),
+            "epoch": np.asarray(epochs, dtype=np.int16),
+            "minibatch": np.asarray(minibatches, dtype=np.int32),
+            **{name: metrics[:, i] for i, name in enumerate(METRICS)},
+            "actions": _narrow(torch.stack(actions).cpu().numpy()),
+        }
+        self._submit(f"update{update:06d}_epoch{epoch:02d}.npz", chunk)
+
+    def record_update(self, update, **summary):
+        chunk = {k: np.asarray([v], dtype=np.float32) for k, v in summary.items()}
+        chunk["update"] = np.asarray([update], dtype=np.int32)
+        self._submit(f"update{update:06d}.npz", chunk)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
+
+    def _submit(self, name, chunk):
+        self._raise()
+        self._queue.put((os.path.join(self.directory, name), chunk))
+
+    def _raise(self):
+        if self._error is not None:
+            raise RuntimeError("Loss recorder failed to write a chunk") from self._error
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if self._error is not None:
+                continue
+
+            path, chunk = job
+            try:
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    np.savez_compressed(f, **chunk)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self._error = e
+
+
+def _narrow(actions):
+    '''Store actions in int16 when they fit'''
+    if actions.size and np.iinfo(np.int16).min <= actions.min() \
+            and actions.max() <= np.iinfo(np.int16).max:
+        return actions.astype(np.int16)
+    return actions
+
+
+def load_records(directory):
+    '''Read a LossRecorder directory back
+
+    Returns (minibatches, updates): dicts of columns concatenated in update
+    and epoch order. minibatches["actions"] has one entry per minibatch.
+    '''
+    def load(pattern):
+        columns = {}
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            with np.load(path) as chunk:
+                for key in chunk.files:
+                    columns.setdefault(key, []).append(chunk[key])
+        return {k: np.concatenate(v) for k, v in columns.items()}
+
+    return load("update*_epoch*.npz"), load("update[0-9][0-9][0-9][0-9][0-9][0-9].npz")
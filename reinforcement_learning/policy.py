@@ -1,4 +1,5 @@
 import argparse
+import logging
 import torch
 import torch.nn.functional as F
 from typing import Dict
@@ -6,10 +7,13 @@ from typing import Dict
 import pufferlib
 import pufferlib.emulation
 import pufferlib.models
+from pufferlib.frameworks import cleanrl
 
 import nmmo
 from nmmo.entity.entity import EntityState
 
+from reinforcement_learning.distributions import FusedMultiDiscrete
+
 EntityId = EntityState.State.attr_name_to_col["id"]
 
 
@@ -34,24 +38,97 @@ class Random(pufferlib.models.Policy):
     return torch.zeros((hidden.shape[0], 1)).to(hidden.device)
 
 
+def compile_function(fn):
+  '''torch.compile `fn`, falling back to eager if compilation fails
+
+  Compilation is lazy, so failures surface on the first call. That call and
+  every later one then run `fn` eagerly. Without torch.compile (torch < 2.0),
+  `fn` is returned unchanged.
+  '''
+  if not hasattr(torch, "compile"):
+    logging.warning("torch.compile is not available in torch %s, running eagerly",
+                    torch.__version__)
+    return fn
+
+  compiled = torch.compile(fn)
+  state = {"fn": compiled}
+
+  def call(*args):
+    if state["fn"] is compiled:
+      try:
+        return compiled(*args)
+      except Exception as e: # pylint: disable=broad-except
+        logging.warning("Compiling %s failed, running eagerly: %s", fn.__name__, e)
+        state["fn"] = fn
+    return state["fn"](*args)
+
+  return call
+
+
+class FusedPolicy(cleanrl.Policy):
+  '''cleanrl.Policy that samples and scores all action heads at once
+
+  Uses FusedMultiDiscrete instead of a per-head loop, in both the rollout
+  and the training forward. Actions are returned as [batch, heads].
+  '''
+  def get_action_and_value(self, x, action=None):
+    logits, value = self.policy(x)
+    dist = FusedMultiDiscrete(logits)
+    if action is None:
+      action = dist.sample()
+    else:
+      action = action.view(-1, dist.num_heads)
+    return action, dist.log_prob(action), dist.entropy(), value
+
+
 class Baseline(pufferlib.models.Policy):
-  def __init__(self, env, input_size=256, hidden_size=256, task_size=4096):
+  def __init__(self, env, input_size=256, hidden_size=256, task_size=4096,
+               compile_mode=False, task_embeddings=None, fused_decoder=False,
+               sparse_entities=False):
     super().__init__(env)
+    # Compile encode_observations and decode_actions on first use. Both the
+    # rollout and the training forward go through these methods
+    if compile_mode and not hasattr(torch, "compile"):
+      logging.warning("compile_mode needs torch>=2.0 (found %s), running eagerly",
+                      torch.__version__)
+      compile_mode = False
+    self.compile_mode = compile_mode
+    self._compiled = {}
 
     self.flat_observation_space = env.flat_observation_space
     self.flat_observation_structure = env.flat_observation_structure
 
     self.tile_encoder = TileEncoder(input_size)
-    self.player_encoder = PlayerEncoder(input_size, hidden_size)
+    self.player_encoder = PlayerEncoder(input_size, hidden_size, sparse=sparse_entities)
     self.item_encoder = ItemEncoder(input_size, hidden_size)
     self.inventory_encoder = InventoryEncoder(input_size, hidden_size)
     self.market_encoder = MarketEncoder(input_size, hidden_size)
-    self.task_encoder = TaskEncoder(input_size, hidden_size, task_size)
+    self.task_encoder = TaskEncoder(input_size, hidden_size, task_size, task_embeddings)
     self.proj_fc = torch.nn.Linear(5 * input_size, input_size)
-    self.action_decoder = ActionDecoder(input_size, hidden_size)
+    self.action_decoder = ActionDecoder(input_size, hidden_size, fused=fused_decoder)
     self.value_head = torch.nn.Linear(hidden_size, 1)
 
+  def __getstate__(self):
+    # Compiled functions do not pickle; they are rebuilt on first use
+    state = self.__dict__.copy()
+    state["_compiled"] = {}
+    return state
+
+  def _call(self, name, fn, *args):
+    if not self.compile_mode:
+      return fn(*args)
+    compiled = self._compiled.get(name)
+    if compiled is None:
+      compiled = self._compiled[name] = compile_function(fn)
+    return compiled(*args)
+
   def encode_observations(self, flat_observations):
+    return self._call("encode_observations", self._encode_observations, flat_observations)
+
+  def decode_actions(self, hidden, lookup):
+    return self._call("decode_actions", self._decode_actions, hidden, lookup)
+
+  def _encode_observations(self, flat_observations):
     env_outputs = pufferlib.emulation.unpack_batched_obs(flat_observations,
         self.flat_observation_space, self.flat_observation_structure)
     tile = self.tile_encoder(env_outputs["Tile"])
@@ -77,7 +154,7 @@ class Baseline(pufferlib.models.Policy):
         env_outputs["ActionTargets"],
     )
 
-  def decode_actions(self, hidden, lookup):
+  def _decode_actions(self, hidden, lookup):
     actions = self.action_decoder(hidden, lookup)
     value = self.value_head(hidden)
     return actions, value
@@ -116,8 +193,15 @@ class TileEncoder(torch.nn.Module):
 
 
 class PlayerEncoder(torch.nn.Module):
-  def __init__(self, input_size, hidden_size):
+  '''Embeds every entity row, and the agent's own row separately
+
+  The sparse implementation runs the embedding and agent_fc only on
+  occupied rows. Empty (all-zero) rows all get the encoding of a zero row,
+  so its outputs are the dense ones.
+  '''
+  def __init__(self, input_size, hidden_size, sparse=False):
     super().__init__()
+    self.sparse = sparse
     self.entity_dim = 31
     self.player_offset = torch.tensor([i * 256 for i in range(self.entity_dim)])
     self.embedding = torch.nn.Embedding(self.entity_dim * 256, 32)
@@ -134,6 +218,9 @@ class PlayerEncoder(torch.nn.Module):
         mask.any(dim=1), mask.argmax(dim=1), torch.zeros_like(mask.sum(dim=1))
     )
 
+    if self.sparse:
+      return self._sparse_forward(agents, row_indices)
+
     agent_embeddings = self.embedding(
         agents.long().clip(0, 255) + self.player_offset.to(agents.device)
     )
@@ -152,6 +239,28 @@ class PlayerEncoder(torch.nn.Module):
 
     return agent_embeddings, my_agent_embeddings
 
+  def _embed(self, rows):
+    embeddings = self.embedding(
+        rows.long().clip(0, 255) + self.player_offset.to(rows.device)
+    )
+    return embeddings.flatten(start_dim=-2)
+
+  def _sparse_forward(self, agents, row_indices):
+    batch, agent, attrs = agents.shape
+    rows = agents.reshape(batch * agent, attrs)
+    occupied = rows.ne(0).any(dim=1).nonzero(as_tuple=True)[0]
+
+    empty = self.agent_fc(self._embed(rows.new_zeros(1, attrs)))
+    agent_embeddings = empty.repeat(batch * agent, 1).index_copy(
+        0, occupied, self.agent_fc(self._embed(rows[occupied]))
+    )
+    agent_embeddings = agent_embeddings.view(batch, agent, -1)
+
+    my_agent_embeddings = self._embed(agents[torch.arange(batch), row_indices])
+    my_agent_embeddings = F.relu(self.my_agent_fc(my_agent_embeddings))
+
+    return agent_embeddings, my_agent_embeddings
+
 
 class ItemEncoder(torch.nn.Module):
   def __init__(self, input_size, hidden_size):
@@ -220,17 +329,70 @@ class MarketEncoder(torch.nn.Module):
 
 
 class TaskEncoder(torch.nn.Module):
-  def __init__(self, input_size, hidden_size, task_size):
+  '''Projects the task embedding, or looks it up by task index
+
+  With task_embeddings ([num_tasks, task_size], as returned by
+  environment.load_task_table), the observed task is an index into that
+  table. Outside of autograd the projected table is cached until fc changes.
+  '''
+  def __init__(self, input_size, hidden_size, task_size, task_embeddings=None):
     super().__init__()
     self.fc = torch.nn.Linear(task_size, input_size)
 
+    table = None
+    if task_embeddings is not None:
+      table = torch.tensor(task_embeddings, dtype=torch.float32)
+    # Not persistent, so that state dicts match the embedding mode
+    self.register_buffer("task_table", table, persistent=False)
+    self._projected = None
+    self._projected_key = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["_projected"] = None
+    state["_projected_key"] = None
+    return state
+
   def forward(self, task):
-    return self.fc(task.clone())
+    if self.task_table is None:
+      return self.fc(task.clone())
+
+    index = task[:, 0].long()
+    if torch.is_grad_enabled():
+      return self.fc(self.task_table)[index]
+    return self._projected_table()[index]
+
+  def _projected_table(self):
+    # Optimizer steps and load_state_dict bump the parameter versions
+    key = (self.fc.weight._version, self.fc.bias._version, self.fc.weight.data_ptr(),
+           self.task_table.device,
+           torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype(),
+           torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype())
+    if self._projected_key != key:
+      self._projected = self.fc(self.task_table)
+      self._projected_key = key
+    return self._projected
 
 
 class ActionDecoder(torch.nn.Module):
-  def __init__(self, input_size, hidden_size):
+  '''One logit head per action argument, masked by the ActionTargets
+
+  Target heads score the player, inventory or market embeddings. The fused
+  implementation runs every head projection as one linear over the
+  concatenated layer weights, scores each embedding family with one bmm and
+  masks all heads at once. It uses the same parameters, so either
+  implementation loads the other's checkpoints.
+  '''
+  # Target heads that score the same embeddings, in layer order
+  TARGET_FAMILIES = (
+      ("attack_target", "inventory_give_player", "gold_target"),
+      ("inventory_destroy", "inventory_give_item", "inventory_sell", "inventory_use"),
+      ("market_buy",),
+  )
+
+  def __init__(self, input_size, hidden_size, fused=False):
     super().__init__()
+    self.fused = fused
     self.layers = torch.nn.ModuleDict(
         {
             "attack_style": torch.nn.Linear(hidden_size, 3),
@@ -292,6 +454,9 @@ class ActionDecoder(torch.nn.Module):
         "inventory_use": action_targets["Use"]["InventoryItem"],
     }
 
+    if self.fused:
+      return self._fused_forward(hidden, embeddings, action_targets)
+
     actions = []
     for key, layer in self.layers.items():
       mask = None
@@ -306,3 +471,27 @@ class ActionDecoder(torch.nn.Module):
       actions.append(action)
 
     return actions
+
+  def _fused_forward(self, hidden, embeddings, action_targets):
+    keys = list(self.layers.keys())
+    layers = list(self.layers.values())
+    weight = torch.cat([layer.weight for layer in layers])
+    bias = torch.cat([layer.bias for layer in layers])
+    projected = torch.nn.functional.linear(hidden, weight, bias)
+    logits = dict(zip(keys, projected.split([layer.out_features for layer in layers], dim=-1)))
+
+    for family in self.TARGET_FAMILIES:
+      embs = embeddings[family[0]]
+      width = action_targets[family[0]].shape[1]
+      if embs.shape[1] != width:
+        # Zero embeddings for the no-op targets
+        embs = torch.nn.functional.pad(embs, (0, 0, 0, width - embs.shape[1]))
+
+      queries = torch.stack([logits[key] for key in family], dim=1)
+      scores = torch.bmm(queries, embs.transpose(1, 2))
+      logits.update(zip(family, scores.unbind(dim=1)))
+
+    masks = [action_targets[key] for key in keys]
+    logits = torch.cat([logits[key] for key in keys], dim=-1)
+    logits = logits.masked_fill(torch.cat(masks, dim=-1) == 0, -1e9)
+    return list(logits.split([mask.shape[1] for mask in masks], dim=-1))
@@ -0,0 +1,61 @@
+# Background minibatch loading for CleanPuffeRL.train
+import queue
+import threading
+import time
+
+
+class MinibatchPrefetcher:
+    '''Calls load(key) for each key in order, up to `depth` keys ahead
+
+    Loading runs on a background thread so the gather, decode and device
+    transfer of the next minibatch overlap the update on the current one.
+    With depth 0, keys are loaded synchronously by next(). Either way,
+    wait_time accumulates the seconds next() spent blocked on data.
+    '''
+    def __init__(self, load, keys, depth=2):
+        self.load = load
+        self.keys = iter(keys)
+        self.depth = depth
+        self.wait_time = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        if depth > 0:
+            self._queue = queue.Queue(maxsize=depth)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for key in self.keys:
+                if not self._put((True, self.load(key))):
+                    return
+        except Exception as e:
+            self._put((False, e))
+
+    def next(self):
+        start = time.perf_counter()
+        try:
+            if self._thread is None:
+                return self.load(next(self.keys))
+
+            ok, item = self._queue.get()
+            if not ok:
+                raise item
+            return item
+        finally:
+            self.wait_time += time.perf_counter() - start
+
+    def close(self):
+        '''Stop loading; keys that were not consumed are dropped'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,104 @@
+# Per-stage rollout latency instrumentation for CleanPuffeRL
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram:
+    '''Log-spaced latency histogram, 1us to 100s at ~5% bucket resolution
+
+    Memory is constant regardless of how many samples are recorded.
+    '''
+    min_latency = 1e-6
+    max_latency = 1e2
+    buckets_per_decade = 48
+
+    def __init__(self):
+        decades = math.log10(self.max_latency / self.min_latency)
+        self.counts = np.zeros(int(decades * self.buckets_per_decade) + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        if seconds <= self.min_latency:
+            bucket = 0
+        else:
+            bucket = int(math.log10(seconds / self.min_latency) * self.buckets_per_decade) + 1
+            bucket = min(bucket, len(self.counts) - 1)
+
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q):
+        '''Upper edge of the bucket holding the q-th percentile, in seconds'''
+        if self.count == 0:
+            return 0.0
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+        return self.min_latency * 10 ** (bucket / self.buckets_per_decade)
+
+
+class RolloutProfiler:
+    '''Latency histograms per rollout stage, per buffer and per env worker
+
+    Stages are timed with stage(name, scope), or recorded directly with
+    record(). Every sample also feeds the "all" scope of its stage.
+    Recording is thread-safe, for pipelined rollouts.
+    '''
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        self.histograms = {}
+
+    def record(self, name, seconds, scope=None):
+        keys = [(name, "all")] if scope is None else [(name, "all"), (name, scope)]
+        with self._lock:
+            for key in keys:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = LatencyHistogram()
+                histogram.record(seconds)
+
+    @contextmanager
+    def stage(self, name, scope=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, scope)
+
+    def total(self, name):
+        histogram = self.histograms.get((name, "all"))
+        return histogram.total if histogram is not None else 0.0
+
+    def summary(self):
+        '''Flat {stage/scope/metric: value} dict of latency percentiles in ms'''
+        summary = {}
+        for (name, scope), histogram in sorted(self.histograms.items()):
+            prefix = f"{name}/{scope}"
+            for q in PERCENTILES:
+                summary[f"{prefix}/p{q}_ms"] = histogram.percentile(q) * 1e3
+            summary[f"{prefix}/mean_ms"] = histogram.total / histogram.count * 1e3
+            summary[f"{prefix}/total_s"] = histogram.total
+            summary[f"{prefix}/count"] = histogram.count
+        return summary
+
+
+class JsonlSink:
+    '''Appends one JSON record per call to a local file'''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def write(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
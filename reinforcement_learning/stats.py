@@ -0,0 +1,101 @@
+# Streaming aggregation of rollout infos for CleanPuffeRL
+import math
+import numbers
+from collections import defaultdict
+
+import numpy as np
+
+# Info keys (and key prefixes, matched on "/" boundaries) emitted by the
+# NMMO postprocessor. Numeric keys are reduced to moments, retained keys keep
+# their raw values until the end of the epoch, ignored keys are dropped.
+NUMERIC_KEYS = ("return", "length", "stats")
+RETAINED_KEYS = ("team_results", "curriculum")
+IGNORED_KEYS = ("Task_eval_fn",)
+
+NUMERIC, RETAINED, IGNORED = range(3)
+
+
+def _matches(name, keys):
+    return any(name == k or name.startswith(k + "/") for k in keys)
+
+
+class StreamingStats:
+    '''Per-policy count/sum/sumsq/min/max of numeric infos
+
+    Replaces lists of every info value with constant memory per key.
+    Keys outside the preregistered schema are classified once, from their
+    first value, instead of trying float() on every field.
+    '''
+    def __init__(self, numeric_keys=NUMERIC_KEYS, retained_keys=RETAINED_KEYS,
+                 ignored_keys=IGNORED_KEYS):
+        self.numeric_keys = tuple(numeric_keys)
+        self.retained_keys = tuple(retained_keys)
+        self.ignored_keys = tuple(ignored_keys)
+        self._kinds = {}
+        self.skipped = 0  # numeric values that did not convert to float
+
+        # policy -> name -> [count, sum, sumsq, min, max]
+        self.moments = defaultdict(dict)
+        # policy -> name -> raw values, for retained keys only
+        self.retained = defaultdict(lambda: defaultdict(list))
+
+    def _classify(self, name, value):
+        if any(k in name for k in self.ignored_keys):
+            kind = IGNORED
+        elif _matches(name, self.retained_keys):
+            kind = RETAINED
+        elif _matches(name, self.numeric_keys):
+            kind = NUMERIC
+        elif isinstance(value, (numbers.Number, np.number, np.bool_)):
+            kind = NUMERIC
+        else:
+            kind = IGNORED
+
+        self._kinds[name] = kind
+        return kind
+
+    def add(self, policy, name, value):
+        kind = self._kinds.get(name)
+        if kind is None:
+            kind = self._classify(name, value)
+
+        if kind == NUMERIC:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                # Skipped like the per-value float() of the old aggregation
+                self.skipped += 1
+                return
+
+            moments = self.moments[policy].get(name)
+            if moments is None:
+                self.moments[policy][name] = [1, value, value * value, value, value]
+            else:
+                moments[0] += 1
+                moments[1] += value
+                moments[2] += value * value
+                if value < moments[3]:
+                    moments[3] = value
+                if value > moments[4]:
+                    moments[4] = value
+        elif kind == RETAINED:
+            self.retained[policy][name].append(value)
+
+    def means(self, policy):
+        return {name: m[1] / m[0] for name, m in self.moments[policy].items()}
+
+    def summary(self):
+        '''policy -> name -> count, mean, std, min and max'''
+        summary = {}
+        for policy, moments in self.moments.items():
+            summary[policy] = {}
+            for name, (count, total, sumsq, low, high) in moments.items():
+                mean = total / count
+                summary[policy][name] = {
+                    "count": count,
+                    "mean": mean,
+                    "std": math.sqrt(max(sumsq / count - mean * mean, 0.0)),
+                    "min": low,
+                    "max": high,
+                }
+        return summary
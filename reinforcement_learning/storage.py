@@ -0,0 +1,172 @@
+# Rollout storage backends for CleanPuffeRL
+import mmap
+import os
+
+import numpy as np
+import torch
+
+# Narrowest lossless storage dtype for integer observation segments
+INTEGER_DTYPES = [
+    (np.uint8, torch.uint8),
+    (np.int8, torch.int8),
+    (np.int16, torch.int16),
+    (np.int32, torch.int32),
+]
+
+
+def _leaf_spaces(flat_observation_space):
+    if hasattr(flat_observation_space, "values"):
+        return list(flat_observation_space.values())
+    return list(flat_observation_space)
+
+
+def storage_dtype(space):
+    '''Narrowest torch dtype that holds every value of a leaf space exactly'''
+    if hasattr(space, "n"):  # Discrete
+        low, high = 0, space.n - 1
+    else:
+        dtype = np.dtype(space.dtype)
+        if dtype.kind == "f":
+            return torch.float16 if dtype.itemsize <= 2 else torch.float32
+        if dtype.kind not in "iub":
+            return torch.float32
+        low, high = np.min(space.low), np.max(space.high)
+
+    for np_dtype, torch_dtype in INTEGER_DTYPES:
+        info = np.iinfo(np_dtype)
+        if info.min <= low and high <= info.max:
+            return torch_dtype
+    return torch.float32
+
+
+def observation_segments(flat_observation_space):
+    '''(start, end, dtype) column ranges of the flat observation
+
+    Consecutive leaves with the same storage dtype are merged into one segment.
+    '''
+    segments = []
+    start = 0
+    for space in _leaf_spaces(flat_observation_space):
+        end = start + int(np.prod(space.shape))
+        dtype = storage_dtype(space)
+        if segments and segments[-1][2] == dtype:
+            segments[-1] = (segments[-1][0], end, dtype)
+        else:
+            segments.append((start, end, dtype))
+        start = end
+    return segments
+
+
+class CompressedObservations:
+    '''Flat observations stored per segment in their native or narrowest dtype
+
+    Supports the subset of the tensor API that CleanPuffeRL uses on data.obs:
+    assigning rows decodes nothing, and indexing returns float32 rows.
+    Use select() to gather rows while keeping them compressed.
+    '''
+    def __init__(self, segments, tensors):
+        self.segments = segments
+        self.tensors = tensors
+
+    @classmethod
+    def allocate(cls, num_rows, flat_observation_space, device="cpu", zeros=None):
+        '''zeros(name, shape, dtype) overrides how segment tensors are allocated'''
+        if zeros is None:
+            zeros = lambda name, shape, dtype: torch.zeros(shape, dtype=dtype, device=device)
+
+        segments = observation_segments(flat_observation_space)
+        tensors = [
+            zeros(f"obs_{i}", (num_rows, end - start), dtype)
+            for i, (start, end, dtype) in enumerate(segments)
+        ]
+        return cls(segments, tensors)
+
+    @property
+    def device(self):
+        return self.tensors[0].device
+
+    @property
+    def shape(self):
+        return (*self.tensors[0].shape[:-1], self.segments[-1][1])
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.tensors)
+
+    def __len__(self):
+        return self.tensors[0].shape[0]
+
+    def __setitem__(self, rows, obs):
+        for (start, end, _), tensor in zip(self.segments, self.tensors):
+            tensor[rows] = obs[..., start:end].to(tensor.dtype)
+
+    def __getitem__(self, rows):
+        return torch.cat([t[rows].float() for t in self.tensors], dim=-1)
+
+    def select(self, rows):
+        '''Gather rows without decoding them'''
+        return CompressedObservations(self.segments, [t[rows] for t in self.tensors])
+
+    def to(self, device):
+        return CompressedObservations(self.segments, [t.to(device) for t in self.tensors])
+
+
+class MemmapAllocator:
+    '''Allocates rollout arrays as memory-mapped files under `directory`
+
+    Arrays are returned as CPU tensors sharing memory with the file, so the
+    page cache rather than process memory holds the rollout. Access pattern
+    hints are passed to the kernel with madvise where available.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.arrays = {}
+
+    def zeros(self, name, shape, dtype):
+        np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+        path = os.path.join(self.directory, f"{name}.bin")
+        array = np.memmap(path, mode="w+", dtype=np_dtype, shape=tuple(shape))
+        self.arrays[name] = array
+        return torch.from_numpy(array)
+
+    def _madvise(self, array, advice, start=0, length=None):
+        mapping = getattr(array, "_mmap", None)
+        if mapping is None or not hasattr(mapping, "madvise"):
+            return
+        if length is None:
+            mapping.madvise(advice)
+        else:
+            mapping.madvise(advice, start, length)
+
+    def advise_sequential(self):
+        '''Rollout writes go front to back'''
+        for array in self.arrays.values():
+            self._madvise(array, getattr(mmap, "MADV_SEQUENTIAL", mmap.MADV_NORMAL))
+
+    def prefetch(self, rows):
+        '''Ask the kernel to read ahead the pages holding `rows` of every array'''
+        advice = getattr(mmap, "MADV_WILLNEED", None)
+        if advice is None:
+            return
+
+        rows = np.unique(np.asarray(rows).ravel())
+        if len(rows) == 0:
+            return
+
+        # madvise each run of consecutive rows once
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        runs = [(run[0], run[-1] + 1) for run in np.split(rows, breaks)]
+        for array in self.arrays.values():
+            row_bytes = array.strides[0]
+            for first, last in runs:
+                start = int(first) * row_bytes // mmap.PAGESIZE * mmap.PAGESIZE
+                end = min(int(last) * row_bytes, array.nbytes)
+                if end > start:
+                    self._madvise(array, advice, start, end - start)
+
+    def release(self):
+        '''Drop the mapped pages from process memory; the file keeps the data'''
+        for array in self.arrays.values():
+            array.flush()
+            self._madvise(array, getattr(mmap, "MADV_DONTNEED", mmap.MADV_NORMAL))
@@ -0,0 +1,214 @@
+# Shared-memory vectorization backend for CleanPuffeRL
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import pufferlib.emulation
+import pufferlib.vectorization
+
+
+class SharedArray:
+    '''Numpy view of a named shared memory block'''
+    def __init__(self, shape, dtype, name=None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def spec(self):
+        return self.shape, self.dtype, self.shm.name
+
+    def close(self, unlink=False):
+        del self.array
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class DriverEnv:
+    '''Picklable spaces of a worker's driver env
+
+    Stands in for driver_env in the trainer process, which only needs the
+    spaces to build policies and storage, so no env is created there.
+    '''
+    def __init__(self, env):
+        self.possible_agents = list(env.possible_agents)
+        self.single_observation_space = env.single_observation_space
+        self.single_action_space = env.single_action_space
+        self.structured_observation_space = env.structured_observation_space
+        self.flat_observation_space = env.flat_observation_space
+        self.flat_observation_structure = env.flat_observation_structure
+
+    def unpack_batched_obs(self, batched_obs):
+        return pufferlib.emulation.unpack_batched_obs(
+            batched_obs, self.flat_observation_space, self.flat_observation_structure)
+
+
+WORKER_TIMINGS = ("step", "write", "idle")
+
+
+def _worker_process(env_creator, env_kwargs, envs_per_worker, pipe):
+    '''Steps a Serial vecenv and writes its outputs into the shared ring'''
+    envs = pufferlib.vectorization.Serial(
+        env_creator,
+        env_kwargs=env_kwargs,
+        num_workers=1,
+        envs_per_worker=envs_per_worker,
+    )
+
+    # The trainer allocates the ring from the spaces of the first worker
+    pipe.send(DriverEnv(envs.driver_env))
+    rows, specs = pipe.recv()
+    shared = {k: SharedArray(*spec) for k, spec in specs.items()}
+    obs, rewards, dones, actions = (
+        shared[k].array for k in ("obs", "rewards", "dones", "actions"))
+    ring_size = obs.shape[0]
+    slot = -1
+
+    # Seconds spent stepping envs, writing the ring and waiting for commands
+    # since the last "profile" command
+    timings = dict.fromkeys(WORKER_TIMINGS, 0.0)
+
+    def publish(start):
+        nonlocal slot
+        o, r, d, i = envs.recv()
+        written = time.perf_counter()
+        timings["step"] += written - start
+
+        slot = (slot + 1) % ring_size
+        obs[slot, rows] = o
+        has_dones = len(d) != 0
+        if has_dones:
+            rewards[slot, rows] = r
+            dones[slot, rows] = d
+        timings["write"] += time.perf_counter() - written
+        pipe.send((slot, has_dones, i))
+
+    while True:
+        start = time.perf_counter()
+        command, arg = pipe.recv()
+        timings["idle"] += time.perf_counter() - start
+
+        if command == "reset":
+            start = time.perf_counter()
+            envs.async_reset(arg)
+            publish(start)
+        elif command == "step":
+            start = time.perf_counter()
+            envs.send(actions[rows].copy(), None)
+            publish(start)
+        elif command == "profile":
+            pipe.send(dict(timings))
+            timings = dict.fromkeys(WORKER_TIMINGS, 0.0)
+        elif command == "close":
+            envs.close()
+            for array in shared.values():
+                array.close()
+            pipe.send(None)
+            return
+
+
+class SharedMemoryMultiprocessing:
+    '''Multiprocessing vecenv that returns observations from shared memory
+
+    Each worker steps its envs and writes observations, rewards and dones
+    directly into a preallocated shared-memory ring of `ring_size` slots, and
+    reads its actions from a shared actions array. Only slot indices and
+    infos go over the pipes, and recv() returns numpy views of the ring slot
+    for all workers without concatenating or copying.
+
+    A ring slot is overwritten ring_size steps later, so consumers must copy
+    out what they keep before then (CleanPuffeRL copies into its staging
+    tensors right after recv()).
+    '''
+    def __init__(self, env_creator, env_kwargs=None, num_workers=1,
+                 envs_per_worker=1, ring_size=2):
+        env_kwargs = env_kwargs or {}
+        assert ring_size >= 2, "The ring needs a slot being read and one being written"
+
+        self.num_workers = num_workers
+        self.envs_per_worker = envs_per_worker
+
+        self.pipes, self.processes = [], []
+        for _ in range(num_workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_worker_process,
+                args=(env_creator, env_kwargs, envs_per_worker, child),
+                daemon=True,
+            )
+            process.start()
+            self.pipes.append(parent)
+            self.processes.append(process)
+
+        # Spaces come from the workers' envs rather than a local env
+        self.driver_env = [pipe.recv() for pipe in self.pipes][0]
+        self.single_observation_space = self.driver_env.single_observation_space
+        self.single_action_space = self.driver_env.single_action_space
+        self.num_agents = len(self.driver_env.possible_agents)
+
+        rows_per_worker = envs_per_worker * self.num_agents
+        total_rows = num_workers * rows_per_worker
+
+        self.shared = {
+            "obs": SharedArray(
+                (ring_size, total_rows, *self.single_observation_space.shape),
+                self.single_observation_space.dtype),
+            "rewards": SharedArray((ring_size, total_rows), np.float32),
+            "dones": SharedArray((ring_size, total_rows), np.bool_),
+            "actions": SharedArray(
+                (total_rows, *self.single_action_space.shape),
+                self.single_action_space.dtype),
+        }
+        specs = {k: v.spec() for k, v in self.shared.items()}
+        for w, pipe in enumerate(self.pipes):
+            pipe.send((slice(w * rows_per_worker, (w + 1) * rows_per_worker), specs))
+
+    def async_reset(self, seed=None):
+        for w, pipe in enumerate(self.pipes):
+            pipe.send(("reset", None if seed is None else seed + w * self.envs_per_worker))
+
+    def recv(self):
+        infos = []
+        slots, has_dones = set(), True
+        for pipe in self.pipes:
+            slot, worker_has_dones, worker_infos = pipe.recv()
+            slots.add(slot)
+            has_dones &= worker_has_dones
+            infos.extend(worker_infos)
+
+        assert len(slots) == 1, "Workers are out of step"
+        slot = slots.pop()
+
+        obs = self.shared["obs"].array[slot]
+        if not has_dones:
+            return obs, [], [], infos
+        return obs, self.shared["rewards"].array[slot], self.shared["dones"].array[slot], infos
+
+    def send(self, actions, env_id=None):
+        self.shared["actions"].array[:] = actions
+        for pipe in self.pipes:
+            pipe.send(("step", None))
+
+    def profile(self):
+        '''Per worker {name: seconds} of WORKER_TIMINGS since the last call
+
+        Call between recv() and send(), while the workers wait for actions.
+        '''
+        for pipe in self.pipes:
+            pipe.send(("profile", None))
+        return [pipe.recv() for pipe in self.pipes]
+
+    def close(self):
+        for pipe in self.pipes:
+            pipe.send(("close", None))
+        for pipe, process in zip(self.pipes, self.processes):
+            # Drain a step still in flight before the close acknowledgement
+            while pipe.recv() is not None:
+                pass
+            process.join()
+
+        for array in self.shared.values():
+            array.close(unlink=True)
@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+import torch
+
+from reinforcement_learning.advantages import compute_gae
+
+
+def reference_gae(values, dones, rewards, idxs, gamma, gae_lambda):
+  advantages = torch.zeros(len(idxs) - 1)
+  lastgaelam = 0
+  for t in reversed(range(len(idxs) - 1)):
+    i, i_nxt = idxs[t], idxs[t + 1]
+    nextnonterminal = 1.0 - dones[i_nxt]
+    nextvalues = values[i_nxt]
+    delta = rewards[i_nxt] + gamma * nextvalues * nextnonterminal - values[i]
+    advantages[t] = lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+  return advantages
+
+
+class TestComputeGAE(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.default_rng(0)
+    num_rows = 513
+    self.values = torch.as_tensor(rng.normal(size=num_rows), dtype=torch.float32)
+    self.rewards = torch.as_tensor(rng.normal(size=num_rows), dtype=torch.float32)
+    self.dones = torch.as_tensor(rng.random(num_rows) < 0.05, dtype=torch.float32)
+    self.idxs = rng.permutation(num_rows).tolist()
+    self.expected = reference_gae(
+        self.values, self.dones, self.rewards, self.idxs, 0.99, 0.95)
+
+  def test_matches_reference_loop(self):
+    advantages = compute_gae(self.values, self.dones, self.rewards, self.idxs, 0.99, 0.95)
+    self.assertEqual(advantages.dtype, torch.float32)
+    self.assertEqual(advantages.shape, self.expected.shape)
+    self.assertTrue(torch.equal(advantages, self.expected))
+
+  def test_segments_match_reference_loop(self):
+    # From one segment to more than enough to run them side by side
+    rng = np.random.default_rng(1)
+    for done_rate in (0.0, 0.01, 0.2, 0.5, 1.0):
+      dones = torch.as_tensor(rng.random(len(self.values)) < done_rate, dtype=torch.float32)
+      expected = reference_gae(self.values, dones, self.rewards, self.idxs, 0.99, 0.95)
+      advantages = compute_gae(self.values, dones, self.rewards, self.idxs, 0.99, 0.95)
+      self.assertTrue(torch.equal(advantages, expected), done_rate)
+
+
+if __name__ == "__main__":
+  unittest.main()
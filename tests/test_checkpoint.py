@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from pufferlib.policy_store import DirectoryPolicyStore
+
+from reinforcement_learning import checkpoint
+
+
+class TestCheckpointWriter(unittest.TestCase):
+  def test_retained(self):
+    updates = [1, 2, 3, 4, 5, 6, 7]
+    self.assertEqual(checkpoint.retained(updates), set(updates))
+    self.assertEqual(checkpoint.retained(updates, keep_last=2), {6, 7})
+    self.assertEqual(checkpoint.retained(updates, keep_last=2, keep_every=3), {1, 4, 6, 7})
+
+  def test_retained_keep_every(self):
+    # Saved at update % interval == 1
+    updates = [1, 31, 61, 91, 121, 151]
+    self.assertEqual(checkpoint.retained(updates, keep_every=2, interval=30), {1, 61, 121, 151})
+    self.assertEqual(checkpoint.retained(updates, keep_every=10, interval=30), {1, 151})
+    self.assertEqual(checkpoint.retained(updates, keep_last=1, keep_every=3, interval=30),
+                     {1, 91, 151})
+
+  def test_retained_is_stable_under_pruning(self):
+    kept = []
+    for update in range(1, 302, 30):
+      kept = sorted(checkpoint.retained(kept + [update], keep_every=2, interval=30))
+      self.assertEqual(kept[-1], update)  # trainer.pt's checkpoint survives
+    self.assertEqual(kept, [1, 61, 121, 181, 241, 301])
+
+  def test_to_cpu_copies(self):
+    state = {"state": {0: {"exp_avg": torch.ones(2)}}, "param_groups": [{"lr": 0.1}]}
+    snapshot = checkpoint.to_cpu(state)
+    state["state"][0]["exp_avg"] += 1
+    self.assertTrue(torch.equal(snapshot["state"][0]["exp_avg"], torch.ones(2)))
+    self.assertEqual(snapshot["param_groups"], [{"lr": 0.1}])
+
+  def test_write_and_prune(self):
+    with tempfile.TemporaryDirectory() as data_dir:
+      policy_dir = os.path.join(data_dir, "policies")
+      store = DirectoryPolicyStore(policy_dir)
+      writer = checkpoint.CheckpointWriter(
+          data_dir, store, policy_dir, "run", torch.nn.Linear(1, 1), keep_last=2)
+      for update in range(1, 5):
+        state_dict = {"weight": torch.full((1, 1), float(update)), "bias": torch.zeros(1)}
+        writer.submit(f"run.{update:06d}", state_dict, {"update": update})
+      writer.close()
+
+      self.assertEqual(writer.completed(), [f"run.{u:06d}" for u in range(1, 5)])
+      self.assertEqual(torch.load(os.path.join(data_dir, "trainer.pt")), {"update": 4})
+      self.assertEqual(
+          sorted(os.listdir(policy_dir)),
+          ["run.000003.pt", "run.000003_state.pth", "run.000004.pt", "run.000004_state.pth"])
+      self.assertEqual(store.get_policy("run.000004").name, "run.000004")
+      with self.assertRaises(KeyError):
+        store.get_policy("run.000002")
+      state_dict = torch.load(os.path.join(policy_dir, "run.000003_state.pth"))
+      self.assertTrue(torch.equal(state_dict["weight"], torch.full((1, 1), 3.0)))
+
+  def test_keep_every_without_keep_last_keeps_newest(self):
+    with tempfile.TemporaryDirectory() as data_dir:
+      policy_dir = os.path.join(data_dir, "policies")
+      store = DirectoryPolicyStore(policy_dir)
+      policy = torch.nn.Linear(1, 1)
+      writer = checkpoint.CheckpointWriter(
+          data_dir, store, policy_dir, "run", policy, keep_every=2, interval=30)
+      for update in (1, 31, 61, 91):
+        writer.submit(f"run.{update:06d}", policy.state_dict(), {"update": update})
+      writer.close()
+
+      self.assertEqual(
+          sorted(f for f in os.listdir(policy_dir) if f.endswith(".pt")),
+          ["run.000001.pt", "run.000061.pt", "run.000091.pt"])
+      self.assertEqual(
+          sorted(f for f in os.listdir(policy_dir) if f.endswith("_state.pth")),
+          ["run.000001_state.pth", "run.000061_state.pth", "run.000091_state.pth"])
+
+
+if __name__ == "__main__":
+  unittest.main()
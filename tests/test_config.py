@@ -0,0 +1,35 @@
+import json
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from reinforcement_learning import config
+
+
+class TestCreateConfig(unittest.TestCase):
+  def test_overrides_file(self):
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+      json.dump({"bptt_horizon": 16, "rollout_batch_size": 2**16}, f)
+      f.flush()
+
+      argv = ["train.py", "--config-overrides", f.name, "--bptt-horizon", "4"]
+      with mock.patch.object(sys, "argv", argv):
+        args = config.create_config(config.Config)
+
+    self.assertEqual(args.rollout_batch_size, 2**16)
+    self.assertEqual(args.bptt_horizon, 4)  # the command line wins
+    self.assertEqual(args.ppo_training_batch_size, config.Config.ppo_training_batch_size)
+
+  def test_unknown_override(self):
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+      json.dump({"not_a_setting": 1}, f)
+      f.flush()
+
+      with mock.patch.object(sys, "argv", ["train.py", "--config-overrides", f.name]):
+        with self.assertRaises(ValueError):
+          config.create_config(config.Config)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+import torch
+import torch.distributed as dist
+
+from reinforcement_learning import distributed
+
+
+def _check_collectives(rank, world_size):
+  # Gradients and advantages differ per rank; every rank must see the
+  # statistics of the union
+  layer = torch.nn.Linear(2, 1)
+  torch.manual_seed(rank)
+  torch.nn.init.normal_(layer.weight)
+  distributed.broadcast_parameters(layer)
+  gathered = [torch.zeros_like(layer.weight) for _ in range(world_size)]
+  dist.all_gather(gathered, layer.weight.data)
+  assert all(torch.equal(g, gathered[0]) for g in gathered)
+
+  layer.weight.grad = torch.full_like(layer.weight, float(rank))
+  distributed.all_reduce_gradients(layer.parameters())
+  assert torch.allclose(layer.weight.grad, torch.full_like(layer.weight, 0.5))
+  assert torch.equal(layer.bias.grad, torch.zeros_like(layer.bias))
+
+  values = torch.arange(4, dtype=torch.float32) + 4 * rank
+  mean, std = distributed.mean_std(values)
+  expected = torch.arange(8, dtype=torch.float32)
+  assert torch.allclose(mean, expected.mean())
+  assert torch.allclose(std, expected.std())
+
+
+class TestDistributed(unittest.TestCase):
+  def test_collectives(self):
+    distributed.launch(_check_collectives, 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,35 @@
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from reinforcement_learning.loss_recorder import LossRecorder, load_records
+
+
+class TestLossRecorder(unittest.TestCase):
+  def test_roundtrip(self):
+    with tempfile.TemporaryDirectory() as directory:
+      recorder = LossRecorder(directory)
+      for update in range(2):
+        for epoch in range(2):
+          for mb in range(3):
+            metrics = torch.tensor([mb, 1.0, 2.0, 3.0, 4.0])
+            actions = torch.full((4, 2, 3), mb, dtype=torch.long)
+            recorder.record_minibatch(epoch, mb, metrics, actions)
+          recorder.end_epoch(update, epoch)
+        recorder.record_update(update, pg_loss=0.5, explained_var=np.nan)
+      recorder.close()
+
+      minibatches, updates = load_records(directory)
+      self.assertEqual(minibatches["update"].tolist(), [0] * 6 + [1] * 6)
+      self.assertEqual(minibatches["minibatch"].tolist(), [0, 1, 2] * 4)
+      self.assertEqual(minibatches["pg_loss"].tolist(), [0.0, 1.0, 2.0] * 4)
+      self.assertEqual(minibatches["actions"].shape, (12, 4, 2, 3))
+      self.assertEqual(minibatches["actions"].dtype, np.int16)
+      self.assertEqual(updates["update"].tolist(), [0, 1])
+      self.assertEqual(updates["pg_loss"].tolist(), [0.5, 0.5])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,138 @@
+import unittest
+from unittest import mock
+
+import torch
+
+from reinforcement_learning.policy import (
+    ActionDecoder, EntityId, PlayerEncoder, TaskEncoder, compile_function)
+
+
+class TestTaskEncoder(unittest.TestCase):
+  def setUp(self):
+    torch.manual_seed(0)
+    self.table = torch.randn(5, 32)
+    self.dense = TaskEncoder(16, 16, 32)
+    table = self.table.numpy()
+    table.flags.writeable = False  # as returned by environment.load_task_table
+    self.indexed = TaskEncoder(16, 16, 32, task_embeddings=table)
+    self.indexed.load_state_dict(self.dense.state_dict())
+    self.index = torch.tensor([[3.0], [0.0], [3.0], [4.0]])
+
+  def test_matches_embedding_mode(self):
+    expected = self.dense(self.table[self.index[:, 0].long()])
+    self.assertTrue(torch.allclose(self.indexed(self.index), expected, atol=1e-6))
+    with torch.no_grad():
+      self.assertTrue(torch.allclose(self.indexed(self.index), expected, atol=1e-6))
+
+  def test_state_dict_matches_embedding_mode(self):
+    self.assertEqual(self.indexed.state_dict().keys(), self.dense.state_dict().keys())
+
+  def test_cache_follows_weight_updates(self):
+    with torch.no_grad():
+      before = self.indexed(self.index)
+      self.indexed.fc.weight.add_(1.0)
+      after = self.indexed(self.index)
+    self.assertFalse(torch.allclose(before, after))
+    expected = self.indexed.fc(self.table[self.index[:, 0].long()])
+    self.assertTrue(torch.allclose(after, expected, atol=1e-5))
+
+  def test_cache_follows_autocast_dtype(self):
+    with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+      self.assertEqual(self.indexed(self.index).dtype, torch.bfloat16)
+    with torch.no_grad():
+      self.assertEqual(self.indexed(self.index).dtype, torch.float32)
+
+  def test_table_is_copied(self):
+    self.assertFalse(self.indexed.task_table.data_ptr() == self.table.data_ptr())
+
+  def test_gradients_reach_fc(self):
+    self.indexed(self.index).sum().backward()
+    self.assertIsNotNone(self.indexed.fc.weight.grad)
+
+
+class TestActionDecoder(unittest.TestCase):
+  def setUp(self):
+    torch.manual_seed(0)
+    self.decoder = ActionDecoder(32, 32)
+    self.fused = ActionDecoder(32, 32, fused=True)
+    self.fused.load_state_dict(self.decoder.state_dict())
+
+    batch = 4
+    players, items, market = (torch.randn(batch, n, 32) for n in (10, 12, 20))
+    def mask(width):
+      return (torch.rand(batch, width) > 0.3).float()
+    action_targets = {
+        "Attack": {"Style": mask(3), "Target": mask(11)},
+        "Buy": {"MarketItem": mask(21)},
+        "Destroy": {"InventoryItem": mask(13)},
+        "Give": {"InventoryItem": mask(13), "Target": mask(11)},
+        "GiveGold": {"Price": mask(99), "Target": mask(11)},
+        "Move": {"Direction": mask(5)},
+        "Sell": {"InventoryItem": mask(13), "Price": mask(99)},
+        "Use": {"InventoryItem": mask(13)},
+    }
+    self.hidden = torch.randn(batch, 32)
+    self.lookup = (players, items, market, action_targets)
+
+  def test_fused_matches_layers(self):
+    expected = self.decoder(self.hidden, self.lookup)
+    actual = self.fused(self.hidden, self.lookup)
+    self.assertEqual(len(actual), len(expected))
+    for a, e in zip(actual, expected):
+      self.assertEqual(a.shape, e.shape)
+      self.assertTrue(torch.allclose(a, e, atol=1e-5))
+
+  def test_fused_gradients_match(self):
+    sum(a.sum() for a in self.decoder(self.hidden, self.lookup)).backward()
+    sum(a.sum() for a in self.fused(self.hidden, self.lookup)).backward()
+    for (name, p), f in zip(self.decoder.named_parameters(), self.fused.parameters()):
+      self.assertTrue(torch.allclose(p.grad, f.grad, atol=1e-4), name)
+
+
+class TestPlayerEncoder(unittest.TestCase):
+  def setUp(self):
+    torch.manual_seed(0)
+    self.dense = PlayerEncoder(32, 16)
+    self.sparse = PlayerEncoder(32, 16, sparse=True)
+    self.sparse.load_state_dict(self.dense.state_dict())
+
+    # Mostly empty rows, as outside of crowded areas
+    self.agents = torch.randint(0, 300, (3, 20, 31)).float()
+    self.agents[:, 5:] = 0
+    self.agents[1] = 0
+    self.my_id = self.agents[:, 2, EntityId].clone()
+
+  def test_sparse_matches_dense(self):
+    for expected, actual in zip(self.dense(self.agents, self.my_id),
+                                self.sparse(self.agents, self.my_id)):
+      self.assertEqual(actual.shape, expected.shape)
+      self.assertTrue(torch.allclose(actual, expected, atol=1e-6))
+
+  def test_sparse_gradients_match(self):
+    for encoder in (self.dense, self.sparse):
+      agent_embeddings, my_agent = encoder(self.agents, self.my_id)
+      (agent_embeddings.sum() + my_agent.sum()).backward()
+    for (name, p), s in zip(self.dense.named_parameters(), self.sparse.parameters()):
+      self.assertTrue(torch.allclose(p.grad, s.grad, atol=1e-4), name)
+
+
+class TestCompileFunction(unittest.TestCase):
+  def test_falls_back_to_eager(self):
+    calls = []
+    def fn(x):
+      calls.append(x)
+      return x * 2
+
+    def failing(*args):
+      raise RuntimeError("backend unavailable")
+
+    with mock.patch.object(torch, "compile", return_value=failing) as compile:
+      compiled = compile_function(fn)
+      self.assertTrue(torch.equal(compiled(torch.ones(2)), torch.full((2,), 2.0)))
+      self.assertTrue(torch.equal(compiled(torch.ones(3)), torch.full((3,), 2.0)))
+    compile.assert_called_once_with(fn)
+    self.assertEqual(len(calls), 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
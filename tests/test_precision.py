@@ -0,0 +1,53 @@
+import functools
+import unittest
+from types import SimpleNamespace
+
+import torch
+
+from reinforcement_learning.clean_pufferl import CleanPuffeRL
+
+
+class TinyPolicy(torch.nn.Module):
+  is_recurrent = False
+
+  def __init__(self):
+    super().__init__()
+    self.encoder = torch.nn.Sequential(torch.nn.Linear(8, 32), torch.nn.ReLU())
+    self.actor = torch.nn.Linear(32, 5)
+    self.critic = torch.nn.Linear(32, 1)
+
+  def get_action_and_value(self, obs, action=None):
+    hidden = self.encoder(obs)
+    dist = torch.distributions.Categorical(logits=self.actor(hidden).float())
+    if action is None:
+      action = dist.sample()
+    return action, dist.log_prob(action), dist.entropy(), self.critic(hidden)
+
+
+class TestPrecisionParity(unittest.TestCase):
+  def test_bf16_matches_fp32(self):
+    torch.manual_seed(0)
+    num_rows = 256
+    trainer = SimpleNamespace(
+        agent=TinyPolicy(),
+        device="cpu",
+        precision="fp32",
+        train_data=SimpleNamespace(
+            obs=torch.randn(num_rows, 8),
+            actions=torch.randint(0, 5, (num_rows,)),
+        ),
+    )
+    trainer._autocast = functools.partial(CleanPuffeRL._autocast, trainer)
+    trainer._trajectory_order = lambda data: list(range(num_rows))
+
+    report = CleanPuffeRL.precision_parity(trainer, num_rows)
+    self.assertEqual(report["rows"], num_rows)
+    # Same tolerance as benchmarks/precision_parity.py
+    self.assertLess(report["logprob/mean_abs_diff"], 0.05)
+    self.assertLess(report["entropy/mean_abs_diff"], 0.05)
+    self.assertLess(report["value/mean_abs_diff"], 0.05)
+    self.assertGreater(report["logprob/max_abs_diff"], 0)  # bf16 actually ran
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+
+from reinforcement_learning.prefetch import MinibatchPrefetcher
+
+
+class TestMinibatchPrefetcher(unittest.TestCase):
+  def test_order(self):
+    for depth in (0, 1, 3):
+      loader = MinibatchPrefetcher(lambda mb: mb * 10, [0, 1, 2, 0, 1, 2], depth)
+      self.assertEqual([loader.next() for _ in range(6)], [0, 10, 20, 0, 10, 20])
+      self.assertGreaterEqual(loader.wait_time, 0.0)
+      loader.close()
+
+  def test_close_early(self):
+    loader = MinibatchPrefetcher(lambda mb: mb, range(100), depth=2)
+    self.assertEqual(loader.next(), 0)
+    loader.close()
+    self.assertFalse(loader._thread.is_alive())
+
+  def test_error_propagates(self):
+    def load(mb):
+      if mb == 1:
+        raise ValueError("bad minibatch")
+      return mb
+
+    loader = MinibatchPrefetcher(load, [0, 1, 2], depth=2)
+    self.assertEqual(loader.next(), 0)
+    with self.assertRaises(ValueError):
+      loader.next()
+    loader.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+from reinforcement_learning import profiling
+from reinforcement_learning.clean_pufferl import CleanPuffeRL
+
+
+class TestLatencyHistogram(unittest.TestCase):
+  def test_percentiles_within_bucket_resolution(self):
+    histogram = profiling.LatencyHistogram()
+    for seconds in [1.2e-3] * 90 + [0.5] * 10:
+      histogram.record(seconds)
+
+    self.assertEqual(histogram.count, 100)
+    self.assertAlmostEqual(histogram.total, 90 * 1.2e-3 + 10 * 0.5)
+    self.assertGreaterEqual(histogram.percentile(50), 1.2e-3)
+    self.assertLess(histogram.percentile(50), 1.2e-3 * 1.05)
+    self.assertGreaterEqual(histogram.percentile(99), 0.5)
+    self.assertLess(histogram.percentile(99), 0.5 * 1.05)
+
+  def test_out_of_range(self):
+    histogram = profiling.LatencyHistogram()
+    self.assertEqual(histogram.percentile(50), 0.0)
+    histogram.record(0.0)
+    histogram.record(1e6)
+    self.assertEqual(histogram.counts[0], 1)
+    self.assertEqual(histogram.counts[-1], 1)
+
+
+class TestRolloutProfiler(unittest.TestCase):
+  def test_scopes_feed_all(self):
+    profiler = profiling.RolloutProfiler()
+    profiler.record("recv", 0.25, "buf0")
+    profiler.record("recv", 0.5, "buf1")
+    with profiler.stage("inference"):
+      pass
+
+    self.assertAlmostEqual(profiler.total("recv"), 0.75)
+    self.assertEqual(profiler.total("send"), 0.0)
+    summary = profiler.summary()
+    self.assertEqual(summary["recv/all/count"], 2)
+    self.assertEqual(summary["recv/buf0/count"], 1)
+    self.assertAlmostEqual(summary["recv/buf1/total_s"], 0.5)
+    self.assertEqual(summary["inference/all/count"], 1)
+    self.assertNotIn("inference/None/count", summary)
+
+    profiler.reset()
+    self.assertEqual(profiler.summary(), {})
+
+
+class TestJsonlSink(unittest.TestCase):
+  def test_appends_records(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      sink = profiling.JsonlSink(os.path.join(tmp, "profile", "rollout.jsonl"))
+      sink.write({"update": 1})
+      sink.write({"update": 2})
+      with open(sink.path) as f:
+        self.assertEqual([json.loads(line) for line in f], [{"update": 1}, {"update": 2}])
+
+
+class ProfiledBuffer:
+  def recv(self):
+    return np.zeros((2, 3)), [], [], {}
+
+  def profile(self):
+    return [{"step": 0.25, "write": 0.125, "idle": 0.5},
+            {"step": 0.5, "write": 0.0, "idle": 0.25}]
+
+
+class TestWorkerProfile(unittest.TestCase):
+  def test_recv_records_worker_timings(self):
+    trainer = SimpleNamespace(
+        profile_workers=True,
+        buffers=[ProfiledBuffer()],
+        profiler=profiling.RolloutProfiler(),
+        policy_pool=SimpleNamespace(update_scores=lambda infos, key: infos),
+        _preprocess=lambda buf, o, r, d: (o, o, r, d, np.ones(len(o), dtype=bool)),
+    )
+    counts = SimpleNamespace(step=1, agent_steps=0, padded_steps=0)
+    CleanPuffeRL._recv(trainer, 0, counts)
+
+    summary = trainer.profiler.summary()
+    self.assertAlmostEqual(summary["env/step/worker0/total_s"], 0.25)
+    self.assertAlmostEqual(summary["env/step/worker1/total_s"], 0.5)
+    self.assertAlmostEqual(summary["env/idle/all/total_s"], 0.75)
+    self.assertEqual(summary["env/write/all/count"], 2)
+    self.assertEqual(counts.agent_steps, 2)
+
+
+if __name__ == "__main__":
+  unittest.main()
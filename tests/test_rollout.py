@@ -0,0 +1,310 @@
+import copy
+import functools
+import time
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import psutil
+import torch
+
+from reinforcement_learning import profiling
+from reinforcement_learning.clean_pufferl import CleanPuffeRL
+
+
+class TestStaging(unittest.TestCase):
+  def test_reuses_one_float32_buffer(self):
+    trainer = SimpleNamespace(
+        staging=[{}, {}], pin_staging=False, device="cpu", process=psutil.Process(),
+        staging_stats={"allocations": 0, "allocated_bytes": 0, "copies": 0})
+    stage = functools.partial(CleanPuffeRL._stage, trainer)
+    allocation_stats = functools.partial(CleanPuffeRL.allocation_stats, trainer)
+
+    rng = np.random.default_rng(0)
+    first = stage(0, "obs", rng.integers(-2**15, 2**15, (6, 10), dtype=np.int16))
+    allocations = allocation_stats()["allocations"]
+    for _ in range(20):
+      obs = rng.integers(-2**15, 2**15, (6, 10), dtype=np.int16)
+      staged = stage(0, "obs", obs)
+      self.assertIs(staged, first)
+      self.assertEqual(staged.dtype, torch.float32)
+      self.assertTrue(torch.equal(staged, torch.from_numpy(obs.astype(np.float32))))
+
+    stats = allocation_stats()
+    self.assertEqual(stats["allocations"], allocations)
+    self.assertEqual(stats["allocated_bytes"], 6 * 10 * 4)
+    self.assertEqual(stats["copies"], 21)
+
+    # Another buffer or a new shape gets its own tensor
+    self.assertIsNot(stage(1, "obs", obs), first)
+    self.assertEqual(stage(0, "obs", obs[:3]).shape, (3, 10))
+    self.assertEqual(allocation_stats()["allocations"], allocations + 2)
+
+
+class ReusingPolicyPool:
+  '''Writes every forward into the same output tensors, like PolicyPool'''
+  def __init__(self, num_rows):
+    self.calls = 0
+    self.actions = torch.zeros(num_rows, dtype=torch.long)
+    self.logprob = torch.zeros(num_rows)
+    self.value = torch.zeros(num_rows, 1)
+
+  def forwards(self, obs, lstm_state, done):
+    self.calls += 1
+    self.actions.fill_(self.calls)
+    self.logprob.fill_(-self.calls)
+    self.value.fill_(10 * self.calls)
+    return self.actions, self.logprob, self.value, lstm_state
+
+
+class FakeBuffer:
+  def __init__(self):
+    self.sent = []
+
+  def send(self, actions, mask):
+    self.sent.append(actions.copy())
+
+
+class TestPipelinedRollout(unittest.TestCase):
+  def test_stored_outputs_survive_pool_reuse(self):
+    num_buffers, num_rows = 3, 4
+    pool = ReusingPolicyPool(num_rows)
+    trainer = SimpleNamespace(
+        batch_size=num_buffers * num_rows - 1,
+        num_buffers=num_buffers,
+        pipeline_depth=num_buffers,
+        compact_inference=False,
+        policy_pool=pool,
+        buffers=[FakeBuffer() for _ in range(num_buffers)],
+        profiler=profiling.RolloutProfiler(),
+        data=SimpleNamespace(
+            buf=0,
+            next_lstm_state=[None] * num_buffers,
+            next_done=[None] * num_buffers,
+        ),
+    )
+    trainer._autocast = lambda: torch.autocast("cpu", enabled=False)
+    trainer._infer_and_send = functools.partial(CleanPuffeRL._infer_and_send, trainer)
+
+    def recv(buf, counts):
+      return SimpleNamespace(buf=buf, step=counts.step,
+                             o_device=torch.zeros(num_rows, 1))
+    trainer._recv = recv
+
+    # Store only after every buffer has been inferred, so that a stored
+    # step would see the last forward if it aliased the pool's outputs
+    deadline = time.monotonic() + 5
+    stored = []
+
+    def consume(step, counts, stats, progress_bar):
+      while pool.calls < num_buffers and time.monotonic() < deadline:
+        time.sleep(0.001)
+      stored.append((step.step, step.actions.clone(), step.logprob.clone(),
+                     step.value.clone()))
+      counts.ptr += num_rows
+    trainer._consume = consume
+
+    counts = SimpleNamespace(ptr=0, step=0, inference_rows=0, cancelled=False)
+    CleanPuffeRL._rollout_pipelined(trainer, counts, None, None)
+
+    self.assertGreaterEqual(pool.calls, num_buffers)
+    self.assertEqual(len(stored), num_buffers)
+    for step, actions, logprob, value in stored:
+      self.assertTrue(torch.equal(actions, torch.full((num_rows,), step)))
+      self.assertTrue(torch.equal(logprob, torch.full((num_rows,), -step, dtype=torch.float32)))
+      self.assertTrue(torch.equal(value, torch.full((num_rows,), 10 * step, dtype=torch.float32)))
+    for buf, buffer in enumerate(trainer.buffers):
+      np.testing.assert_array_equal(buffer.sent[0], np.full(num_rows, buf + 1))
+
+
+class ArgmaxPolicy(torch.nn.Module):
+  '''Deterministic multi-head policy, so batch composition does not change actions'''
+  is_recurrent = False
+
+  def __init__(self, heads=3, choices=5):
+    super().__init__()
+    self.heads, self.choices = heads, choices
+    self.actor = torch.nn.Linear(8, heads * choices)
+    self.critic = torch.nn.Linear(8, 1)
+
+  def get_action_and_value(self, obs, action=None):
+    logits = self.actor(obs).view(len(obs), self.heads, self.choices)
+    dist = torch.distributions.Categorical(logits=logits)
+    action = logits.argmax(-1)
+    return action, dist.log_prob(action).sum(-1), dist.entropy().sum(-1), self.critic(obs)
+
+
+class TestCompactInference(unittest.TestCase):
+  def test_matches_full_batch_on_live_rows(self):
+    torch.manual_seed(0)
+    policy = ArgmaxPolicy()
+    trainer = SimpleNamespace(
+        actor=policy,
+        buffers=[SimpleNamespace(single_action_space=SimpleNamespace(shape=(3,)))],
+    )
+    obs = torch.randn(16, 8)
+    alive_mask = np.random.default_rng(0).random(16) < 0.5
+    alive_mask[0], alive_mask[1] = True, False
+
+    with torch.no_grad():
+      actions, logprob, value = CleanPuffeRL._compact_forward(trainer, obs, alive_mask)
+      full_actions, full_logprob, _, full_value = policy.get_action_and_value(obs)
+
+    self.assertEqual(actions.shape, (16, 3))
+    self.assertEqual((logprob.shape, value.shape), ((16,), (16,)))
+    self.assertTrue(torch.equal(actions[alive_mask], full_actions[alive_mask]))
+    self.assertTrue(torch.allclose(logprob[alive_mask], full_logprob[alive_mask], atol=1e-6))
+    self.assertTrue(torch.allclose(value[alive_mask], full_value.flatten()[alive_mask], atol=1e-6))
+
+    dead = ~alive_mask
+    self.assertTrue(torch.equal(actions[dead], torch.zeros(dead.sum(), 3, dtype=torch.long)))
+    self.assertTrue(torch.equal(logprob[dead], torch.zeros(dead.sum())))
+    self.assertTrue(torch.equal(value[dead], torch.zeros(dead.sum())))
+
+  def test_all_dead(self):
+    trainer = SimpleNamespace(
+        actor=None,  # never called
+        buffers=[SimpleNamespace(single_action_space=SimpleNamespace(shape=(3,)))],
+    )
+    actions, logprob, value = CleanPuffeRL._compact_forward(
+        trainer, torch.randn(4, 8), np.zeros(4, dtype=bool))
+    self.assertTrue(torch.equal(actions, torch.zeros(4, 3, dtype=torch.long)))
+    self.assertTrue(torch.equal(logprob, torch.zeros(4)))
+    self.assertTrue(torch.equal(value, torch.zeros(4)))
+
+
+class FakeVecEnv:
+  def __init__(self, step_time=0.0):
+    self.step_time = step_time
+    self.recvs = self.sends = 0
+    self.closed = False
+
+  def recv(self):
+    self.recvs += 1
+
+  def send(self, actions, mask):
+    time.sleep(self.step_time)
+    self.sends += 1
+
+  def close(self):
+    self.closed = True
+
+
+class ActorPool:
+  '''Returns the actor's weight, the learner update it was copied from, as the value'''
+  def __init__(self, actor):
+    self.actor = actor
+
+  def update_policies(self, policies):
+    pass
+
+  def forwards(self, obs, lstm_state, done):
+    num_rows = len(obs)
+    version = self.actor.weight.detach().reshape(1, 1).expand(num_rows, 1).clone()
+    return (torch.zeros(num_rows, dtype=torch.long), torch.zeros(num_rows),
+            version, lstm_state)
+
+
+class TestAsyncRollout(unittest.TestCase):
+  def make_trainer(self, max_policy_lag, steps_per_batch, step_time=0.0):
+    num_buffers, num_rows = 2, 4
+    agent = torch.nn.Linear(1, 1, bias=False)
+    with torch.no_grad():
+      agent.weight.fill_(0)
+    actor = copy.deepcopy(agent)
+
+    rollouts = [
+        SimpleNamespace(
+            buf=0, next_obs=[None] * num_buffers, next_done=[None] * num_buffers,
+            next_lstm_state=[None] * num_buffers, sort_keys=[],
+            slot_cursor=np.zeros(0, dtype=np.int64), overflow=0, policy_version=0,
+            allocator=None, versions=[])
+        for _ in range(2)
+    ]
+    trainer = SimpleNamespace(
+        async_rollout=True, max_policy_lag=max_policy_lag, update=0,
+        agent=agent, actor=actor, actor_version=0, _async_rollout=None,
+        rollouts=rollouts, data=rollouts[0], train_data=None,
+        batch_size=steps_per_batch * num_rows - 1, num_buffers=num_buffers,
+        compact_inference=False, pipelined_rollout=False, device="cpu",
+        buffers=[FakeVecEnv(step_time) for _ in range(num_buffers)],
+        policy_pool=ActorPool(actor),
+        policy_store=SimpleNamespace(select_policies=lambda selector: []),
+        policy_selector=None, process=psutil.Process(),
+        staging_stats={"allocations": 0}, profiler=profiling.RolloutProfiler(),
+        loss_recorder=None, checkpoint_writer=None, wandb_entity=None,
+    )
+    for name in ("start_async_evaluate", "finish_async_evaluate", "cancel_async_evaluate",
+                 "close", "clear_rollout", "_begin_rollout", "_collect",
+                 "_rollout_serial", "_infer_and_send"):
+      setattr(trainer, name, functools.partial(getattr(CleanPuffeRL, name), trainer))
+    trainer._autocast = lambda: torch.autocast("cpu", enabled=False)
+
+    def recv(buf, counts):
+      trainer.buffers[buf].recv()
+      return SimpleNamespace(buf=buf, step=counts.step, o_device=torch.zeros(num_rows, 1))
+    trainer._recv = recv
+
+    def consume(step, counts, stats, progress_bar):
+      if counts.ptr == 0:
+        trainer.data.versions = []
+      trainer.data.versions.append(float(step.value[0]))
+      counts.ptr += num_rows
+    trainer._consume = consume
+
+    def finish_rollout(rollout):
+      trainer.train_data = rollout.data
+      return rollout.data, {}, {}
+    trainer._finish_rollout = finish_rollout
+    return trainer
+
+  def train(self, trainer):
+    trainer.update += 1
+    with torch.no_grad():
+      trainer.agent.weight.fill_(trainer.update)
+
+  def test_rollouts_alternate_within_policy_lag(self):
+    max_policy_lag = 2
+    trainer = self.make_trainer(max_policy_lag, steps_per_batch=3)
+    trained, lags = [], []
+
+    trainer.start_async_evaluate()
+    for _ in range(8):
+      data, _, _ = trainer.finish_async_evaluate()
+      trainer.start_async_evaluate()
+
+      # The next batch is collected into the other storage while this one trains
+      self.assertIsNot(trainer.data, data)
+      trained.append(0 if data is trainer.rollouts[0] else 1)
+      # Every step of the batch ran the policy of data.policy_version
+      self.assertEqual(data.versions, [float(data.policy_version)] * 3)
+      lags.append(trainer.update - data.policy_version)
+      self.train(trainer)
+
+    trainer.cancel_async_evaluate()
+    trainer.close()
+
+    self.assertEqual(trained, [0, 1] * 4)
+    self.assertLessEqual(max(lags), max_policy_lag)
+    self.assertEqual(max(lags), max_policy_lag)  # the snapshot is not refreshed every update
+
+  def test_cancel_leaves_trainer_closeable(self):
+    trainer = self.make_trainer(1, steps_per_batch=1000, step_time=0.001)
+    trainer.start_async_evaluate()
+    rollout = trainer._async_rollout
+    time.sleep(0.05)
+
+    trainer.cancel_async_evaluate()
+    self.assertIsNone(trainer._async_rollout)
+    self.assertFalse(rollout.thread.is_alive())
+    self.assertLess(rollout.counts.ptr, trainer.batch_size + 1)
+    for envs in trainer.buffers:
+      self.assertEqual(envs.recvs, envs.sends)  # streams stay consistent
+
+    trainer.close()
+    self.assertTrue(all(envs.closed for envs in trainer.buffers))
+    trainer.cancel_async_evaluate()  # no rollout in progress
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+import numpy as np
+
+from reinforcement_learning.stats import StreamingStats
+
+
+class TestStreamingStats(unittest.TestCase):
+  def test_moments(self):
+    stats = StreamingStats()
+    values = [1.0, 4.0, 2.5, True]
+    for v in values:
+      stats.add("learner", "stats/task/completed", v)
+
+    summary = stats.summary()["learner"]["stats/task/completed"]
+    self.assertEqual(summary["count"], 4)
+    self.assertAlmostEqual(summary["mean"], np.mean(values))
+    self.assertAlmostEqual(summary["std"], np.std(values))
+    self.assertEqual(summary["min"], 1.0)
+    self.assertEqual(summary["max"], 4.0)
+    self.assertEqual(stats.means("learner"), {"stats/task/completed": np.mean(values)})
+
+  def test_retained_and_ignored(self):
+    stats = StreamingStats()
+    stats.add("learner", "team_results", (1, "result"))
+    stats.add("learner", "curriculum/task_a", [(0.5, 2)])
+    stats.add("learner", "stats/Task_eval_fn", 1.0)
+    stats.add("learner", "unknown_object", object())
+    stats.add("learner", "unknown_number", np.int16(3))
+
+    self.assertEqual(stats.retained["learner"]["team_results"], [(1, "result")])
+    self.assertEqual(stats.retained["learner"]["curriculum/task_a"], [[(0.5, 2)]])
+    self.assertEqual(list(stats.means("learner")), ["unknown_number"])
+
+  def test_unconvertible_numeric_values_are_skipped(self):
+    stats = StreamingStats()
+    stats.add("learner", "return", 2.0)
+    stats.add("learner", "return", "n/a")
+    stats.add("learner", "stats/event", [1, 2])
+    stats.add("learner", "return", 4.0)
+
+    self.assertEqual(stats.skipped, 2)
+    self.assertEqual(stats.means("learner"), {"return": 3.0})
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,96 @@
+import mmap
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from reinforcement_learning import storage
+
+
+def box(shape, low, high, dtype):
+  return SimpleNamespace(shape=shape, low=np.full(shape, low), high=np.full(shape, high),
+                         dtype=np.dtype(dtype))
+
+# Mirrors the leaf layout of the flat NMMO observation
+FLAT_OBSERVATION_SPACE = {
+    "ActionTargets": box((5,), 0, 1, np.int8),
+    "AgentId": box((1,), 0, 2**15 - 1, np.int16),
+    "Entity": box((4, 3), -2**15, 2**15 - 1, np.int16),
+    "Task": box((8,), -1, 1, np.float16),
+}
+
+
+class TestCompressedObservations(unittest.TestCase):
+  def test_segments(self):
+    segments = storage.observation_segments(FLAT_OBSERVATION_SPACE)
+    self.assertEqual(segments, [
+        (0, 5, torch.uint8),
+        (5, 18, torch.int16),
+        (18, 26, torch.float16),
+    ])
+
+  def test_roundtrip(self):
+    obs = storage.CompressedObservations.allocate(10, FLAT_OBSERVATION_SPACE)
+    self.assertEqual(obs.shape, (10, 26))
+    self.assertLess(obs.nbytes, 10 * 26 * 4 / 2)
+
+    rows = torch.cat([
+        torch.randint(0, 2, (4, 5)).float(),
+        torch.randint(-2**15, 2**15, (4, 13)).float(),
+        torch.randn(4, 8).half().float(),
+    ], dim=-1)
+
+    obs[2:6] = rows
+    self.assertTrue(torch.equal(obs[2:6], rows))
+
+    idxs = torch.tensor([[5, 2], [3, 4]])
+    selected = obs.select(idxs)
+    self.assertEqual(selected.shape, (2, 2, 26))
+    self.assertTrue(torch.equal(selected[1], rows[[1, 2]]))
+
+
+class TestMemmapAllocator(unittest.TestCase):
+  def test_roundtrip_after_release(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      allocator = storage.MemmapAllocator(tmp)
+      obs = allocator.zeros("obs", (1000, 37), torch.float32)
+      actions = allocator.zeros("actions", (1000, 3), torch.int64)
+      expected_obs = torch.randn(1000, 37)
+      expected_actions = torch.randint(0, 10, (1000, 3))
+
+      allocator.advise_sequential()
+      obs[:] = expected_obs
+      actions[:] = expected_actions
+      allocator.release()
+
+      self.assertTrue(torch.equal(obs, expected_obs))
+      self.assertTrue(torch.equal(actions, expected_actions))
+      on_disk = np.fromfile(f"{tmp}/obs.bin", dtype=np.float32).reshape(1000, 37)
+      self.assertTrue(torch.equal(torch.from_numpy(on_disk), expected_obs))
+
+  def test_prefetch_ranges_are_page_aligned(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      allocator = storage.MemmapAllocator(tmp)
+      obs = allocator.zeros("obs", (1000, 37), torch.float32)
+      advised = []
+      allocator._madvise = lambda array, advice, start=0, length=None: advised.append(
+          (start, length))
+
+      rows = [999, 3, 4, 5, 500, 4]
+      allocator.prefetch(rows)
+      if not hasattr(mmap, "MADV_WILLNEED"):
+        self.assertEqual(advised, [])
+        return
+
+      row_bytes = obs.stride(0) * obs.element_size()
+      self.assertEqual(len(advised), 3)  # one per run of consecutive rows
+      for (start, length), (first, last) in zip(advised, [(3, 6), (500, 501), (999, 1000)]):
+        self.assertEqual(start % mmap.PAGESIZE, 0)
+        self.assertLessEqual(start, first * row_bytes)
+        self.assertEqual(start + length, min(last * row_bytes, obs.nbytes))
+
+
+if __name__ == "__main__":
+  unittest.main()
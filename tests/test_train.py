@@ -0,0 +1,78 @@
+import copy
+import functools
+import unittest
+from types import SimpleNamespace
+
+import psutil
+import torch
+
+from reinforcement_learning.clean_pufferl import CleanPuffeRL
+
+
+class TinyPolicy(torch.nn.Module):
+  is_recurrent = False
+
+  def __init__(self):
+    super().__init__()
+    self.encoder = torch.nn.Sequential(torch.nn.Linear(8, 32), torch.nn.ReLU())
+    self.actor = torch.nn.Linear(32, 5)
+    self.critic = torch.nn.Linear(32, 1)
+
+  def get_action_and_value(self, obs, action=None):
+    hidden = self.encoder(obs)
+    dist = torch.distributions.Categorical(logits=self.actor(hidden))
+    if action is None:
+      action = dist.sample()
+    else:
+      action = action.reshape(-1)  # [rows, bptt_horizon] in training
+    return action, dist.log_prob(action), dist.entropy(), self.critic(hidden)
+
+
+class TestGradientAccumulation(unittest.TestCase):
+  def make_trainer(self, agent, batch_size):
+    torch.manual_seed(1)
+    num_rows = batch_size + 1
+    trainer = SimpleNamespace(
+        agent=agent,
+        # SGD, so that a wrongly scaled gradient changes the update
+        optimizer=torch.optim.SGD(agent.parameters(), lr=0.1),
+        learning_rate=0.1, update=1, total_updates=10, batch_size=batch_size,
+        device="cpu", precision="fp32", distributed=False, lazy_obs_gather=False,
+        compress_obs=False, prefetch_depth=0, pin_staging=False, loss_recorder=None,
+        wandb_entity=None, verbose=False, checkpoint_interval=1000,
+        process=psutil.Process(),
+        buffers=[SimpleNamespace(single_observation_space=SimpleNamespace(shape=(8,)))],
+        train_data=SimpleNamespace(
+            obs=torch.randn(num_rows, 8),
+            actions=torch.randint(0, 5, (num_rows,)),
+            logprobs=-torch.rand(num_rows) - 1,
+            rewards=torch.randn(num_rows),
+            dones=(torch.rand(num_rows) < 0.1).float(),
+            values=torch.randn(num_rows),
+            policy_version=1, allocator=None, sort_keys=[],
+            slot_cursor=torch.zeros(0).numpy(), overflow=0,
+        ),
+    )
+    trainer._autocast = functools.partial(CleanPuffeRL._autocast, trainer)
+    trainer._trajectory_order = lambda data: list(range(num_rows))
+    trainer.clear_rollout = functools.partial(CleanPuffeRL.clear_rollout, trainer)
+    trainer.done_training = functools.partial(CleanPuffeRL.done_training, trainer)
+    return trainer
+
+  def test_matches_one_large_minibatch(self):
+    torch.manual_seed(0)
+    agent = TinyPolicy()
+    params = {}
+    for steps in (1, 4):
+      trainer = self.make_trainer(copy.deepcopy(agent), batch_size=128)
+      CleanPuffeRL.train(trainer, batch_rows=16, update_epochs=2, bptt_horizon=4,
+                         grad_accumulation_steps=steps, max_grad_norm=1e9)
+      params[steps] = trainer.agent.state_dict()
+
+    for name, expected in params[1].items():
+      self.assertFalse(torch.equal(expected, agent.state_dict()[name]), name)
+      self.assertTrue(torch.allclose(params[4][name], expected, atol=1e-6), name)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from reinforcement_learning.clean_pufferl import CleanPuffeRL
+
+
+def trajectory_data(num_slots, horizon):
+  rows = num_slots * horizon
+  return SimpleNamespace(
+      horizon=horizon,
+      slot_cursor=np.zeros(num_slots, dtype=np.int64),
+      overflow=0,
+      obs=torch.zeros(rows, 4),
+      actions=torch.zeros(rows, 1, dtype=torch.long),
+      logprobs=torch.zeros(rows),
+      rewards=torch.zeros(rows),
+      dones=torch.zeros(rows),
+      values=torch.zeros(rows),
+  )
+
+
+class TestTrajectoryCapacity(unittest.TestCase):
+  def setUp(self):
+    # One buffer of one env with two agents, of which only the first is alive
+    self.trainer = SimpleNamespace(
+        num_buffers=1, num_envs=1, num_agents=2, batch_size=4, device="cpu")
+    self.data = trajectory_data(num_slots=2, horizon=3)
+    self.counts = SimpleNamespace(ptr=0, full_buffers=set())
+
+  def step(self, alive_mask):
+    data, counts = self.data, self.counts
+    overflow = data.overflow
+    stored = CleanPuffeRL._store(
+        self.trainer, data, 0, 0, counts.ptr, np.array(alive_mask),
+        torch.randn(2, 4), torch.randn(2), torch.zeros(2),
+        torch.zeros(2, 1, dtype=torch.long), torch.zeros(2), torch.zeros(2))
+    counts.ptr += stored
+    CleanPuffeRL._check_trajectory_capacity(
+        self.trainer, counts, 0, stored, data.overflow > overflow)
+    return stored
+
+  def test_raises_when_live_slots_are_full(self):
+    for _ in range(3):
+      self.assertEqual(self.step([True, False]), 1)
+
+    with self.assertRaises(RuntimeError):
+      self.step([True, False])
+    self.assertEqual(self.data.overflow, 1)
+
+  def test_fills_when_slots_have_room(self):
+    for _ in range(2):
+      self.step([True, True])
+    self.assertEqual(self.step([True, True]), 1)  # batch_size + 1 cutoff
+    self.assertEqual(self.counts.ptr, 5)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+
+import gym
+import numpy as np
+
+import pufferlib.emulation
+import pufferlib.vectorization
+
+from reinforcement_learning.vectorization import SharedMemoryMultiprocessing
+
+
+class CountingEnv:
+  '''Two agents whose observations, rewards and dones follow the seed, tick and actions'''
+  possible_agents = [1, 2]
+
+  def __init__(self):
+    self.agents = []
+
+  def observation_space(self, agent):
+    return gym.spaces.Box(low=0, high=2**15, shape=(3,), dtype=np.float32)
+
+  def action_space(self, agent):
+    return gym.spaces.Discrete(4)
+
+  def reset(self, seed=None):
+    self.agents = list(self.possible_agents)
+    self.seed, self.tick = (seed or 0) % 1000, 0
+    return {a: self._obs(a, 0) for a in self.agents}
+
+  def step(self, actions):
+    self.tick += 1
+    obs = {a: self._obs(a, actions[a]) for a in self.agents}
+    rewards = {a: float(self.tick * a + actions[a]) for a in self.agents}
+    dones = {a: self.tick >= 3 + a for a in self.agents}
+    self.agents = [a for a in self.agents if not dones[a]]
+    return obs, rewards, dones, {a: {} for a in obs}
+
+  def close(self):
+    pass
+
+  def _obs(self, agent, action):
+    return np.array([self.seed, self.tick * agent, action], dtype=np.float32)
+
+
+def make_env():
+  return pufferlib.emulation.PettingZooPufferEnv(env_creator=CountingEnv)
+
+
+class TestSharedMemoryMultiprocessing(unittest.TestCase):
+  def test_matches_serial(self):
+    serial = pufferlib.vectorization.Serial(make_env, num_workers=2, envs_per_worker=1)
+    shared = SharedMemoryMultiprocessing(make_env, num_workers=2, envs_per_worker=1)
+    try:
+      self.assertEqual(shared.num_agents, serial.num_agents)
+      self.assertEqual(shared.single_observation_space, serial.single_observation_space)
+
+      rng = np.random.default_rng(0)
+      serial.async_reset(7)
+      shared.async_reset(7)
+      for _ in range(8):
+        expected, actual = serial.recv(), shared.recv()
+        for e, a in zip(expected[:3], actual[:3]):
+          np.testing.assert_array_equal(np.asarray(a), np.asarray(e))
+
+        actions = rng.integers(0, 4, (4, *shared.single_action_space.shape))
+        serial.send(actions)
+        shared.send(actions)
+    finally:
+      serial.close()
+      shared.close()
+
+  def test_profile_reports_worker_timings(self):
+    shared = SharedMemoryMultiprocessing(make_env, num_workers=2, envs_per_worker=1)
+    try:
+      shared.async_reset(7)
+      for _ in range(3):
+        shared.recv()
+        profiles = shared.profile()
+        self.assertEqual(len(profiles), 2)
+        for timings in profiles:
+          self.assertEqual(set(timings), {"step", "write", "idle"})
+          self.assertTrue(all(seconds >= 0 for seconds in timings.values()))
+          self.assertGreater(timings["step"], 0)
+        shared.send(np.zeros((4, *shared.single_action_space.shape), dtype=np.int64))
+      shared.recv()
+    finally:
+      shared.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
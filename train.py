@@ -8,32 +8,52 @@ from pufferlib.frameworks import cleanrl
 
 import environment
 
-from reinforcement_learning import clean_pufferl, policy, config
+from reinforcement_learning import clean_pufferl, policy, config, distributed
+from reinforcement_learning.vectorization import SharedMemoryMultiprocessing
 
 # NOTE: this file changes when running curriculum generation track
 # Run test_task_encoder.py to regenerate this file (or get it from the repo)
 BASELINE_CURRICULUM_FILE = "reinforcement_learning/curriculum_with_embedding.pkl"
 CUSTOM_CURRICULUM_FILE = "curriculum_generation/custom_curriculum_with_embedding.pkl"
 
-def setup_env(args):
+def make_vectorization(args):
+    if args.use_serial_vecenv:
+        return Serial
+    if args.shared_memory_vecenv:
+        return SharedMemoryMultiprocessing
+    return Multiprocessing
+
+def setup_env(args, is_distributed=False):
     run_dir = os.path.join(args.runs_dir, args.run_name)
     os.makedirs(run_dir, exist_ok=True)
     logging.info("Training run: %s (%s)", args.run_name, run_dir)
     logging.info("Training args: %s", args)
 
-    policy_store = None
+    policy_store, policy_store_dir = None, None
     if args.policy_store_dir is None:
         args.policy_store_dir = os.path.join(run_dir, "policy_store")
         logging.info("Using policy store from %s", args.policy_store_dir)
         policy_store = DirectoryPolicyStore(args.policy_store_dir)
+        policy_store_dir = args.policy_store_dir
+
+    # The task index table is read once, so the tasks file must not change while training
+    task_embeddings = None
+    if args.task_index_obs:
+        _, task_embeddings = environment.load_task_table(args.tasks_path)
 
     def make_policy(envs):
         learner_policy = policy.Baseline(
             envs.driver_env,
             input_size=args.input_size,
             hidden_size=args.hidden_size,
-            task_size=args.task_size
+            task_size=args.task_size,
+            compile_mode=args.compile_policy,
+            task_embeddings=task_embeddings,
+            fused_decoder=args.fused_action_decoder,
+            sparse_entities=args.sparse_entity_encoding,
         )
+        if args.fused_action_distribution:
+            return policy.FusedPolicy(learner_policy)
         return cleanrl.Policy(learner_policy)
 
     trainer = clean_pufferl.CleanPuffeRL(
@@ -45,33 +65,94 @@ def setup_env(args):
         data_dir=run_dir,
         exp_name=args.run_name,
         policy_store=policy_store,
+        policy_store_dir=policy_store_dir,
         wandb_entity=args.wandb_entity,
         wandb_project=args.wandb_project,
         wandb_extra_data=args,
         checkpoint_interval=args.checkpoint_interval,
-        vectorization=Serial if args.use_serial_vecenv else Multiprocessing,
+        checkpoint_keep_last=args.checkpoint_keep_last,
+        checkpoint_keep_every=args.checkpoint_keep_every,
+        vectorization=make_vectorization(args),
         total_timesteps=args.train_num_steps,
         num_envs=args.num_envs,
         num_cores=args.num_cores or args.num_envs,
         num_buffers=args.num_buffers,
         batch_size=args.rollout_batch_size,
+        trajectory_storage=args.trajectory_storage,
+        trajectory_horizon=args.trajectory_horizon or None,
+        compress_obs=args.compress_obs,
+        compact_inference=args.compact_inference,
+        profile_workers=args.profile_workers,
+        pipelined_rollout=args.pipelined_rollout,
+        pipeline_depth=args.pipeline_depth,
+        lazy_obs_gather=args.lazy_obs_gather,
+        storage_backend=args.storage_backend,
+        prefetch_depth=args.prefetch_depth,
+        precision=args.precision,
         learning_rate=args.ppo_learning_rate,
         selfplay_learner_weight=args.learner_weight,
         selfplay_num_policies=args.max_opponent_policies + 1,
-        #record_loss = args.record_loss,
+        record_loss=args.record_loss,
+        async_rollout=args.async_rollout,
+        max_policy_lag=args.max_policy_lag,
+        distributed=is_distributed,
     )
     return trainer
 
+def run_learner(rank, world_size, args):
+    """One of world_size data-parallel learners on the rl track
+
+    Envs, rollout steps and minibatch rows are split evenly across learners,
+    so the global batch matches a single-learner run.
+    """
+    for name in ("num_envs", "rollout_batch_size", "ppo_training_batch_size"):
+        if getattr(args, name) % world_size != 0:
+            raise ValueError(f"{name} must be divisible by num_learners")
+    args.num_envs //= world_size
+    args.num_cores = (args.num_cores or args.num_envs * world_size) // world_size
+    args.rollout_batch_size //= world_size
+    args.ppo_training_batch_size //= world_size
+    args.train_num_steps //= world_size
+
+    # Check the per-learner shapes here rather than in train() on every rank
+    if args.ppo_training_batch_size == 0 or args.ppo_training_batch_size % args.bptt_horizon != 0:
+        raise ValueError(
+            f"ppo_training_batch_size per learner ({args.ppo_training_batch_size}) "
+            f"must be a nonzero multiple of bptt_horizon ({args.bptt_horizon})")
+    if args.rollout_batch_size % args.ppo_training_batch_size != 0:
+        raise ValueError(
+            f"rollout_batch_size per learner ({args.rollout_batch_size}) must be "
+            f"divisible by ppo_training_batch_size per learner ({args.ppo_training_batch_size})")
+
+    trainer = setup_env(args, is_distributed=True)
+    reinforcement_learning_track(trainer, args)
+    trainer.close()
+
 def reinforcement_learning_track(trainer, args):
-    while not trainer.done_training():
-        trainer.evaluate()
+    def train():
         trainer.train(
             update_epochs=args.ppo_update_epochs,
             bptt_horizon=args.bptt_horizon,
             batch_rows=args.ppo_training_batch_size // args.bptt_horizon,
             clip_coef=args.clip_coef,
+            grad_accumulation_steps=args.ppo_grad_accumulation_steps,
         )
 
+    if not args.async_rollout:
+        while not trainer.done_training():
+            trainer.evaluate()
+            train()
+        return
+
+    # Collect the next batch while the current one trains
+    trainer.start_async_evaluate()
+    while not trainer.done_training():
+        trainer.finish_async_evaluate()
+        trainer.start_async_evaluate()
+        train()
+    # The batch in flight would never be trained on
+    trainer.cancel_async_evaluate()
+
 def curriculum_generation_track(trainer, args, use_elm=True):
     from curriculum_generation.task_encoder import TaskEncoder
     LLM_CHECKPOINT = "Salesforce/codegen25-7b-instruct"
@@ -108,7 +189,6 @@ def curriculum_generation_track(trainer, args, use_elm=True):
     # Use the train_task_spec to train agents
     task_encoder.get_task_embedding(curriculum, save_to_file=CUSTOM_CURRICULUM_FILE)
     task_encoder.close()
-    trainer.data.sort_keys = []
     reinforcement_learning_track(trainer, args)
 
 if __name__ == "__main__":
@@ -127,13 +207,18 @@ if __name__ == "__main__":
 
     if args.track == "rl":
       args.tasks_path = BASELINE_CURRICULUM_FILE
-      trainer = setup_env(args)
-      reinforcement_learning_track(trainer, args)
+      if args.num_learners > 1:
+        distributed.launch(run_learner, args.num_learners, args)
+      else:
+        trainer = setup_env(args)
+        reinforcement_learning_track(trainer, args)
+        trainer.close()
     elif args.track == "curriculum":
+      assert args.num_learners == 1, "Only the rl track supports multiple learners"
+      assert not args.task_index_obs, "The curriculum track rewrites the tasks file"
       args.tasks_path = CUSTOM_CURRICULUM_FILE
       trainer = setup_env(args)
       curriculum_generation_track(trainer, args, use_elm=True)
+      trainer.close()
     else:
       raise ValueError(f"Unknown track {args.track}, must be 'rl' or 'curriculum'")
-
-    trainer.close()